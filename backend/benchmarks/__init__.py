@@ -0,0 +1,7 @@
+"""
+Benchmark harness
+
+Generates a synthetic question bank, drives every route through the Flask
+test client or a real HTTP server at a set concurrency, and reports
+throughput and latency percentiles as JSON. See backend/README.md.
+"""
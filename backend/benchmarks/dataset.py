@@ -0,0 +1,69 @@
+import random
+
+from sqlalchemy import func
+
+from models.models import db, Question, Category
+
+WORDS = [
+    'what', 'which', 'who', 'where', 'when', 'how', 'is', 'was', 'the', 'largest',
+    'smallest', 'first', 'last', 'famous', 'river', 'mountain', 'city', 'country', 'painter', 'novel',
+    'movie', 'actor', 'element', 'planet', 'ocean', 'team', 'player', 'king', 'queen', 'war',
+    'empire', 'bridge', 'island', 'desert', 'song', 'album', 'composer', 'theory', 'scientist', 'animal',
+    'language', 'capital', 'continent', 'sport', 'trophy', 'museum', 'statue', 'poet', 'engine', 'galaxy',
+]
+CATEGORY_TYPES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+
+
+"""
+synthetic_questions(categories, questions_per_category, difficulties, seed)
+    yields question rows spread evenly over every (category, difficulty)
+    pair, with texts drawn from WORDS so that search and suggestions match
+"""
+def synthetic_questions(categories, questions_per_category, difficulties, seed=0):
+    rng = random.Random(seed)
+    for index in range(questions_per_category):
+        for category in range(1, categories + 1):
+            yield {
+                'question': ' '.join(rng.choices(WORDS, k=6)) + f' {index}?',
+                'answer': ' '.join(rng.choices(WORDS, k=2)),
+                'category': category,
+                'difficulty': index % difficulties + 1,
+            }
+
+
+"""
+generate(app, categories, questions_per_category, difficulties, batch_size, seed)
+    fills the empty database of app with categories and synthetic
+    questions, inserted batch_size rows at a time, and returns its
+    description (see describe())
+"""
+def generate(app, categories=6, questions_per_category=1000, difficulties=5, batch_size=10000, seed=0):
+    with app.app_context():
+        db.session.execute(Category.__table__.insert(), [
+            {'type': CATEGORY_TYPES[index] if index < len(CATEGORY_TYPES) else f'Category {index + 1}'}
+            for index in range(categories)
+        ])
+        batch = []
+        for question in synthetic_questions(categories, questions_per_category, difficulties, seed):
+            batch.append(question)
+            if len(batch) == batch_size:
+                db.session.execute(Question.__table__.insert(), batch)
+                batch = []
+        if batch:
+            db.session.execute(Question.__table__.insert(), batch)
+        db.session.commit()
+    return describe(app)
+
+
+"""
+describe(app)
+    returns the number of categories, the highest question id and the
+    highest difficulty of the database of app
+"""
+def describe(app):
+    with app.app_context():
+        return {
+            'categories': Category.query.count(),
+            'questions': Question.query.with_entities(func.max(Question.id)).scalar() or 0,
+            'difficulties': Question.query.with_entities(func.max(Question.difficulty)).scalar() or 1,
+        }
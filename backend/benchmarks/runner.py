@@ -0,0 +1,165 @@
+import http.client
+import os
+import random
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+
+class FlaskClientTarget:
+    """Sends requests through the Flask test client, one client per thread."""
+
+    mode = 'test_client'
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def send(self, method, path, body=None, content_type=None):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        response = self.local.client.open(path, method=method, data=body, content_type=content_type)
+        data = response.get_data()
+        response.close()
+        return response.status_code, data
+
+
+class HttpTarget:
+    """Sends requests over HTTP to a running server."""
+
+    mode = 'http'
+
+    def __init__(self, base_url):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+
+    def send(self, method, path, body=None, content_type=None):
+        connection = http.client.HTTPConnection(self.host, self.port)
+        try:
+            connection.request(method, path, body=body,
+                               headers={'Content-Type': content_type} if content_type else {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Request handler without the access log, which would skew timings."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+@contextmanager
+def serve(app):
+    """Serve app with the threaded Werkzeug server on a free port, yield its URL."""
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+"""
+percentile(sorted_values, fraction)
+    nearest-rank percentile of an already sorted list
+"""
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+"""
+rss_bytes()
+    resident set size of the current process, its peak where /proc is
+    not available
+"""
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+"""
+run_scenario(target, scenario, state, requests, concurrency, seed)
+    sends `requests` requests of scenario from `concurrency` threads and
+    returns their throughput, latency percentiles (in milliseconds) and
+    the number of unexpected statuses
+"""
+def run_scenario(target, scenario, state, requests, concurrency, seed=0):
+    if scenario.prepare is not None:
+        scenario.prepare(target.send, state)
+    remaining = iter(range(requests))
+    lock = threading.Lock()
+    latencies, errors = [], []
+
+    def worker(worker_seed):
+        rng = random.Random(worker_seed)
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            request = scenario.build(rng, state)
+            start = time.perf_counter()
+            status, _ = target.send(*request)
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                if status not in scenario.statuses:
+                    errors.append(status)
+
+    threads = [threading.Thread(target=worker, args=(seed * 1000 + index,)) for index in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'scenario': scenario.name,
+        'mode': target.mode,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+    }
+
+
+"""
+compare(baseline, results)
+    pairs the results of two runs by scenario and mode, with the ratio of
+    their throughputs and p95 latencies (above 1 means the new run is
+    faster, respectively slower)
+"""
+def compare(baseline, results):
+    previous = {(result['scenario'], result['mode']): result for result in baseline['results']}
+    comparison = []
+    for result in results['results']:
+        before = previous.get((result['scenario'], result['mode']))
+        if before is None or not before['throughput'] or not before['p95_ms']:
+            continue
+        comparison.append({
+            'scenario': result['scenario'],
+            'mode': result['mode'],
+            'throughput_ratio': round(result['throughput'] / before['throughput'], 3),
+            'p95_ratio': round(result['p95_ms'] / before['p95_ms'], 3),
+        })
+    return comparison
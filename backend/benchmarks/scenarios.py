@@ -0,0 +1,108 @@
+import itertools
+import json
+import threading
+
+from flask import json as flask_json
+
+from .dataset import WORDS, synthetic_questions
+
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+BULK_ROWS = 100
+
+
+class Scenario:
+    """
+    Requests of one route. `build(rng, state)` returns the
+    `(method, path, body, content_type)` of the next request, with body
+    None or bytes. `prepare(send, state)` runs once before the first one.
+    """
+
+    def __init__(self, name, build, prepare=None, statuses=(200,)):
+        self.name = name
+        self.build = build
+        self.prepare = prepare
+        self.statuses = statuses
+
+
+def get(path):
+    return 'GET', path, None, None
+
+
+def post_json(path, payload):
+    return 'POST', path, json.dumps(payload).encode('utf-8'), JSON_MIMETYPE
+
+
+def random_category(rng, state):
+    return rng.randint(1, state['dataset']['categories'])
+
+
+def random_id(rng, state):
+    return rng.randint(1, state['dataset']['questions'])
+
+
+def prepare_session(send, state):
+    status, body = send(*post_json('/quizzes/sessions', {'quiz_category': {'id': 0, 'type': 'click'}}))
+    state['session_id'] = flask_json.loads(body)['session_id']
+
+
+def prepare_deletions(send, state):
+    # Delete synthetic questions from the last one down, each only once,
+    # even when the scenario runs again in another mode
+    state.setdefault('deletions', itertools.count(state['dataset']['questions'], -1))
+    state.setdefault('deletions_lock', threading.Lock())
+
+
+def next_deletion(state):
+    with state['deletions_lock']:
+        return next(state['deletions'])
+
+
+def bulk_body(rng, state):
+    rows = synthetic_questions(state['dataset']['categories'], BULK_ROWS // state['dataset']['categories'] + 1,
+                               state['dataset']['difficulties'], seed=rng.random())
+    return ''.join(json.dumps(row) + '\n' for row in itertools.islice(rows, BULK_ROWS)).encode('utf-8')
+
+
+"""
+Every route of the API, deletions last as they remove synthetic questions
+"""
+SCENARIOS = [
+    Scenario('get_categories', lambda rng, state: get('/categories')),
+    Scenario('get_questions', lambda rng, state: get(
+        f"/questions?page={rng.randint(1, max(state['dataset']['questions'] // 10, 1))}")),
+    Scenario('get_questions_after_id', lambda rng, state: get(
+        f'/questions?after_id={random_id(rng, state) - 1}')),
+    Scenario('questions_by_category', lambda rng, state: get(
+        f'/categories/{random_category(rng, state)}/questions?page={rng.randint(1, 100)}'),
+        statuses=(200, 404)),
+    Scenario('search_questions', lambda rng, state: post_json(
+        '/questions/search', {'searchTerm': ' '.join(rng.sample(WORDS, 2))})),
+    Scenario('suggest_questions', lambda rng, state: get(
+        f'/questions/suggest?prefix={rng.choice(WORDS)}%20{rng.choice(WORDS)[:2]}')),
+    Scenario('quiz', lambda rng, state: post_json('/quizzes', {
+        'previous_questions': [random_id(rng, state) for _ in range(5)],
+        'quiz_category': {'id': rng.randint(0, state['dataset']['categories']), 'type': 'click'},
+    })),
+    Scenario('create_quiz_session', lambda rng, state: post_json(
+        '/quizzes/sessions', {'quiz_category': {'id': random_category(rng, state), 'type': 'click'}})),
+    Scenario('next_quiz_question', lambda rng, state: post_json(
+        f"/quizzes/sessions/{state['session_id']}/next", {}), prepare=prepare_session),
+    # Clients syncing their copy of the questions, about 100 changes behind
+    Scenario('question_changes', lambda rng, state: get(
+        f"/questions/changes?since={max(state['dataset']['questions'] - rng.randint(0, 100), 0)}")),
+    Scenario('cache_stats', lambda rng, state: get('/cache/stats')),
+    Scenario('pool_stats', lambda rng, state: get('/pool/stats')),
+    Scenario('metrics', lambda rng, state: get('/metrics')),
+    Scenario('create_question', lambda rng, state: post_json('/questions', {
+        'question': ' '.join(rng.choices(WORDS, k=6)) + '?',
+        'answer': rng.choice(WORDS),
+        'category': random_category(rng, state),
+        'difficulty': rng.randint(1, state['dataset']['difficulties']),
+    })),
+    Scenario('bulk_questions', lambda rng, state: (
+        'POST', '/questions/bulk', bulk_body(rng, state), NDJSON_MIMETYPE)),
+    Scenario('export_questions', lambda rng, state: get('/questions/export')),
+    Scenario('delete_question', lambda rng, state: (
+        'DELETE', f'/questions/{next_deletion(state)}', None, None), prepare=prepare_deletions),
+]
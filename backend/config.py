@@ -1,7 +1,97 @@
 import os
-SECRET_KEY = os.urandom(32)
+# Signs the pagination cursors. Every worker and host must share it, or the
+# cursors issued by one fail on the others and after each restart. Required
+# in production, drawn at random per process otherwise
+SECRET_KEY = os.environ.get('SECRET_KEY')
 
 # IMPLEMENT DATABASE URL
 DATABASE_NAME = 'trivia'
 SQLALCHEMY_DATABASE_URI = 'postgresql://{}/{}'.format('postgres:abc@localhost:5432', DATABASE_NAME)
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Connection pool of each process, overridable from the environment
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# Seconds to wait for a free connection, and before reopening a connection
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# Test connections on checkout, so those dropped by a failover are replaced
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true') == 'true'
+# Read replicas, as a comma separated DB_REPLICA_URIS environment variable
+SQLALCHEMY_REPLICA_URIS = [uri for uri in os.environ.get('DB_REPLICA_URIS', '').split(',') if uri]
+# Seconds between two health checks of a replica
+REPLICA_CHECK_INTERVAL = 5
+# Requests with this header read from the primary, e.g. right after a write
+READ_PRIMARY_HEADER = 'X-Read-Primary'
+# Behind PgBouncer: open a connection per checkout and let PgBouncer pool them
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'false') == 'true'
+
+# Quiz sessions kept in memory by the API
+QUIZ_SESSION_TTL = 60 * 60
+QUIZ_SESSION_MAX = 10000
+QUIZ_SESSION_STORE = None
+# Questions drawn at most by one POST /quizzes with `count`
+QUIZ_MAX_COUNT = 50
+
+# Seconds before the cached category map is reloaded
+CATEGORY_CACHE_TTL = 5 * 60
+
+# Serve the question listings, searches and quizzes from a column-oriented
+# copy of the question bank loaded in each process, instead of the database.
+# Turns CHANGE_FEED on ('listen') when it is not set, to follow other processes
+QUESTION_SNAPSHOT = os.environ.get('QUESTION_SNAPSHOT', 'false') == 'true'
+
+# File, preferably on a tmpfs such as /dev/shm, holding the categories and
+# questions read once for every worker of the host to warm up from. Disabled
+# when empty
+SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH')
+
+# Apply the question and category writes of other processes and hosts to the
+# in-process caches: 'listen' (Postgres LISTEN/NOTIFY, polling on other
+# databases), 'poll', or disabled when empty
+CHANGE_FEED = os.environ.get('CHANGE_FEED')
+# Seconds between two reads of the changes table when polling
+CHANGE_POLL_INTERVAL = 0.2
+# Age in seconds from which `flask prune-changes` deletes the tombstones and
+# superseded changes. Feeds and clients further behind resync from scratch
+CHANGES_RETENTION_SECONDS = int(os.environ.get('CHANGES_RETENTION_SECONDS', 7 * 24 * 60 * 60))
+
+# Seconds before the in-memory question counters are checked against the database
+QUESTION_COUNTS_RECONCILE_INTERVAL = 60
+# Seconds before the quiz sampler reloads the question ids written by other
+# processes, when CHANGE_FEED does not apply them
+QUESTION_SAMPLER_RECONCILE_INTERVAL = 60
+
+# Number of suggestions returned by /questions/suggest, by default and at most
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
+
+# Rows per transaction of POST /questions/bulk and per fetch of GET /questions/export
+BULK_CHUNK_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+
+# Cache-Control header of the conditional GET endpoints, by endpoint name
+# (endpoints not listed here are sent with 'no-cache')
+CACHE_CONTROL = {
+    'get_categories': 'public, max-age=60',
+    'get_questions': 'public, no-cache',
+    'questions_by_category': 'public, no-cache',
+}
+
+# Response cache of question pages and search results
+RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+RESPONSE_CACHE_TTL = 60
+# Backend object with get(key), set(key, value, ttl) and stats() methods, in-process LRU if None
+RESPONSE_CACHE_BACKEND = None
+
+# Encoder of the JSON responses: 'orjson', 'json' (stdlib) or None for the fastest installed
+JSON_SERIALIZER = None
+
+# Questions per page of the listings, by default and at most (`per_page` argument)
+QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+
+# Statements slower than this many seconds, and requests running more
+# queries than QUERY_COUNT_WARNING, are logged as warnings
+SLOW_QUERY_SECONDS = 0.5
+QUERY_COUNT_WARNING = 20
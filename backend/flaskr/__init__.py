@@ -1,36 +1,218 @@
-import random
+import os
 import sys
 
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, stream_with_context
 from flask_cors import CORS
+from itsdangerous import BadSignature
 from sqlalchemy import exc
 
 from models.request_schema import *
-from models.models import setup_db, Question, Category
-from config import SECRET_KEY
-from . import error_handler
-
-QUESTIONS_PER_PAGE = 10
-
-
-def paginate_questions(request, selection):
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
-    return current_questions
+from models.models import setup_db, on_question_change, on_category_change, db, Question
+from models.pool import pool_stats
+from models.routing import use_primary
+from . import error_handler, bulk
+from .pagination import paginate_questions, paginate_snapshot, InvalidProjection
+from .sampler import QuestionSampler
+from .quiz_sessions import QuizSessions, InMemorySessionStore
+from .cache import CategoryCache, ResponseCache, InMemoryLRUBackend
+from .counts import QuestionCounts
+from .search import QuestionSearch
+from .suggest import SuggestIndex
+from .snapshot import QuestionSnapshot
+from .shared_cache import SharedPayloads, question_rows
+from . import changes
+from .changes import ChangeFeed
+from .serializer import get_serializer, json_response
+from .metrics import Instrumentation, render_samples, PROMETHEUS_MIMETYPE
+from .conditional import ResourceVersions, conditional
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
     app.register_blueprint(error_handler.blueprint)
-    app.config['SECRET_KEY'] = SECRET_KEY
-    setup_db(app)
+    app.config.from_object('config')
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    if not app.config['SECRET_KEY']:
+        if app.env == 'production':
+            raise RuntimeError('SECRET_KEY must be set in production, the same for every worker and host')
+        app.config['SECRET_KEY'] = os.urandom(32)
+    if app.config['QUESTION_SNAPSHOT'] and not app.config['CHANGE_FEED']:
+        # The snapshot only sees the writes of other processes through the feed
+        app.config['CHANGE_FEED'] = 'listen'
+    setup_db(app, app.config['SQLALCHEMY_DATABASE_URI'])
     cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+    # JSON encoder of the API responses, orjson when installed
+    serializer = get_serializer(app.config['JSON_SERIALIZER'])
+    app.extensions['json_serializer'] = serializer
+
+    # Categories and questions published once for every worker of the host
+    shared = None
+    if app.config['SHARED_CACHE_PATH']:
+        shared = SharedPayloads(app.config['SHARED_CACHE_PATH'])
+        app.extensions['shared_payloads'] = shared
+        on_question_change(app, shared.on_change)
+        on_category_change(app, shared.on_change)
+
+    # Question ids per category, used to pick quiz questions
+    sampler = QuestionSampler(
+        reconcile_interval=None if app.config['CHANGE_FEED'] else app.config['QUESTION_SAMPLER_RECONCILE_INTERVAL'])
+    app.extensions['question_sampler'] = sampler
+    on_question_change(app, sampler.on_question_change)
+
+    # Full-text search, with an in-process index when not on Postgres
+    question_search = QuestionSearch()
+    app.extensions['question_search'] = question_search
+    on_question_change(app, question_search.on_question_change)
+
+    # Prefix index for search-as-you-type suggestions
+    suggest_index = SuggestIndex()
+    app.extensions['suggest_index'] = suggest_index
+    on_question_change(app, suggest_index.on_question_change)
+
+    # Opt-in column snapshot of the questions, serving the read endpoints
+    snapshot = None
+    if app.config['QUESTION_SNAPSHOT']:
+        snapshot = QuestionSnapshot()
+        app.extensions['question_snapshot'] = snapshot
+        on_question_change(app, snapshot.on_question_change)
+
+    def serving_snapshot():
+        return snapshot is not None and snapshot.is_loaded
+
+    # Writes of other processes and hosts, applied through the listeners
+    # (created once the caches it resyncs exist, see below)
+    change_feed = None
+
+    def load_questions():
+        # Every structure is built from the same read of the questions,
+        # mapped from the shared payloads when another worker published them
+        try:
+            rows = question_rows(shared, serializer)
+        except:
+            print(sys.exc_info())
+            rows = None
+        try:
+            sampler.warm(rows)
+        except:
+            # Stay cold and sample with SQL until the next restart
+            print(sys.exc_info())
+        if snapshot is not None:
+            try:
+                snapshot.load(rows)
+            except:
+                # Serve from the database until the next restart
+                print(sys.exc_info())
+        try:
+            # The snapshot resolves searches with the in-process indexes
+            question_search.setup(in_process=snapshot is not None, rows=rows)
+        except:
+            print(sys.exc_info())
+        try:
+            suggest_index.warm(rows)
+        except:
+            # Built on the first suggestion request instead
+            print(sys.exc_info())
+
+    @app.before_first_request
+    def warm_up():
+        # Changes committed while warming up are applied again afterwards,
+        # the listeners replace questions they already hold
+        since = None
+        if change_feed is not None:
+            try:
+                since = change_feed.current_version()
+            except:
+                print(sys.exc_info())
+        load_questions()
+        if since is not None:
+            change_feed.start(since)
+
+    # Question counters, total and per category
+    question_counts = QuestionCounts(reconcile_interval=app.config['QUESTION_COUNTS_RECONCILE_INTERVAL'])
+    app.extensions['question_counts'] = question_counts
+    on_question_change(app, question_counts.on_question_change)
+
+    def total_after_write():
+        # The write is committed whatever happens here, report it without a total
+        try:
+            return question_counts.total()
+        except:
+            print(sys.exc_info())
+            return None
+
+    # Category map shared by /categories and /questions
+    category_cache = CategoryCache(ttl=app.config['CATEGORY_CACHE_TTL'], serializer=serializer, shared=shared)
+    app.extensions['category_cache'] = category_cache
+    on_category_change(app, lambda action, category: category_cache.invalidate())
+
+    def resync():
+        # Rebuild what the pruned changes would have updated
+        if shared is not None:
+            shared.bump()
+        load_questions()
+        question_counts.reconcile()
+        category_cache.invalidate()
+
+    if app.config['CHANGE_FEED']:
+        change_feed = ChangeFeed(app, app.config['CHANGE_FEED'], app.config['CHANGE_POLL_INTERVAL'], resync=resync)
+        app.extensions['change_feed'] = change_feed
+
+    @app.cli.command('prune-changes')
+    def prune_changes_command():
+        """Delete the changes older than CHANGES_RETENTION_SECONDS that no sync needs."""
+        deleted = changes.prune_changes(app.config['CHANGES_RETENTION_SECONDS'])
+        print(f'{deleted} changes pruned')
+
+    def sync_local_state(entity, version):
+        # Responses tagged with a version are built from state that applied it
+        if change_feed is not None:
+            change_feed.catch_up(version)
+        elif entity == 'question':
+            question_counts.sync(version)
+
+    # Versions behind the ETags of the read endpoints, shared by every process
+    versions = ResourceVersions(sync=sync_local_state)
+    app.extensions['resource_versions'] = versions
+
+    def categories_validator():
+        version, modified = versions.get('category')
+        # Categories cached before the last category change are reloaded
+        return category_cache.get(version=version).digest, modified
+
+    # Serialised pages of questions and search results
+    response_cache = ResponseCache(
+        app.config['RESPONSE_CACHE_BACKEND'] or InMemoryLRUBackend(max_bytes=app.config['RESPONSE_CACHE_MAX_BYTES']),
+        ttl=app.config['RESPONSE_CACHE_TTL'],
+    )
+    app.extensions['response_cache'] = response_cache
+
+    # Pre-shuffled quiz sessions
+    quiz_sessions = QuizSessions(app.config['QUIZ_SESSION_STORE'] or InMemorySessionStore(
+        max_sessions=app.config['QUIZ_SESSION_MAX'],
+        ttl=app.config['QUIZ_SESSION_TTL'],
+    ))
+
+
+    # Request and SQL metrics, served by /metrics and logged per request.
+    # Registered first so that it measures the final responses
+    instrumentation = Instrumentation(
+        slow_query_seconds=app.config['SLOW_QUERY_SECONDS'],
+        query_count_warning=app.config['QUERY_COUNT_WARNING'],
+    )
+    app.extensions['metrics'] = instrumentation
+    app.before_request(instrumentation.start_request)
+    app.after_request(instrumentation.end_request)
+
+
+    @app.before_request
+    def route_reads():
+        # Read-your-writes for clients that just wrote through another request
+        if app.config['READ_PRIMARY_HEADER'] in request.headers:
+            use_primary(db)
+
 
     @app.after_request
     def after_request(response):
@@ -40,55 +222,55 @@ def create_app(test_config=None):
 
     
     @app.route('/categories')
+    @conditional(lambda: [categories_validator()])
     def get_categories():
         # Get categories
         try:
-            categories = Category.query.order_by(Category.id).all()
+            cached_categories = category_cache.get()
         except:
             print(sys.exc_info())
             abort (500)
         # If there is no category, return 404
-        if len(categories) == 0:
+        if len(cached_categories.categories) == 0:
             abort (404)
-        categories_dict = {}
-        for category in categories:
-            categories_dict[category.id] = category.type
-        return jsonify({
-            'success': True,
-            'categories': categories_dict,
-            'total_categories': len(categories)
-        })
+        # The response body is serialised once per cache refresh
+        return app.response_class(cached_categories.body, mimetype='application/json')
 
 
     @app.route('/questions')
+    @conditional(lambda: [versions.get('question'), categories_validator()])
+    @response_cache.cached(lambda: [versions.get('question')[0], category_cache.get().digest])
     def get_questions():
-        # Get questions
+        # Get the current page of questions
         try:
-            retrieved_questions = Question.query.order_by(Question.id).all()
+            if serving_snapshot():
+                current_questions, total_questions, next_cursor = paginate_snapshot(request, snapshot)
+            else:
+                current_questions, total_questions, next_cursor = paginate_questions(
+                    request, Question.query, total_questions=question_counts.total())
+        except (BadSignature, InvalidProjection):
+            print(sys.exc_info())
+            abort (400)
         except:
             print(sys.exc_info())
             abort (500)
         # If there is no question, return 404
-        if len(retrieved_questions) == 0:
+        if len(current_questions) == 0:
             abort (404)
-        # Paginate
-        try:     
-            categories = Category.query.order_by(Category.id).all()     
-            current_questions = paginate_questions(request, retrieved_questions)
+        try:
+            categories = category_cache.get().categories
         except:
             print(sys.exc_info())
             abort (500)
-        # If there is no question, return 404
+        # If there is no category, return 404
         if len(categories) == 0:
             abort (404)
-        categories_dict = {}
-        for category in categories:
-            categories_dict[category.id] = category.type
-        return jsonify({
+        return json_response({
             'success': True,
             'questions': current_questions,
-            'categories': categories_dict,
-            'total_questions': len(retrieved_questions),
+            'categories': categories,
+            'total_questions': total_questions,
+            'next_cursor': next_cursor,
         })
 
 
@@ -107,10 +289,10 @@ def create_app(test_config=None):
         except:
             print(sys.exc_info())
             abort (500)
-        return jsonify({
+        return json_response({
             'success': True,
             'deleted': id,
-            'total_questions': len(Question.query.all())
+            'total_questions': total_after_write()
         })
 
 
@@ -142,58 +324,227 @@ def create_app(test_config=None):
         except:
             print(sys.exc_info())
             abort (500)
-        return jsonify({
+        return json_response({
             'success': True,
             'created': new_question.id,
-            'total_questions': len(Question.query.all())
+            'total_questions': total_after_write()
+        })
+
+
+    @app.route('/questions/bulk', methods=['POST'])
+    def bulk_create_questions():
+        # Rows are parsed lazily from the request stream
+        if request.mimetype == bulk.CSV_MIMETYPE:
+            rows = bulk.read_csv(request.stream)
+        elif request.mimetype in bulk.NDJSON_MIMETYPES:
+            rows = bulk.read_ndjson(request.stream)
+        else:
+            abort (400)
+        try:
+            categories = category_cache.get().categories
+            created, errors = bulk.import_questions(rows, categories, app.config['BULK_CHUNK_SIZE'])
+        except bulk.ImportInterrupted as interrupted:
+            print(sys.exc_info())
+            # The chunks committed before the error stay imported
+            return json_response({
+                'success': False,
+                'error': 500,
+                'message': 'Internal Server Error',
+                'created': len(interrupted.created),
+                'errors': interrupted.errors,
+                'interrupted_at_row': interrupted.row,
+            }, 500)
+        except:
+            print(sys.exc_info())
+            abort (500)
+        return json_response({
+            'success': True,
+            'created': len(created),
+            'errors': errors,
+            'total_questions': total_after_write(),
         })
 
 
+    @app.route('/questions/export')
+    def export_questions():
+        export_format = request.args.get('format', 'ndjson')
+        if export_format == 'csv':
+            mimetype = bulk.CSV_MIMETYPE
+        elif export_format == 'ndjson':
+            mimetype = bulk.NDJSON_MIMETYPES[0]
+        else:
+            abort (400)
+        rows = bulk.export_questions(export_format, app.config['EXPORT_BATCH_SIZE'], serializer)
+        return app.response_class(stream_with_context(rows), mimetype=mimetype)
+
+
+    @app.route('/questions/changes')
+    def question_changes():
+        since = request.args.get('since', type=int)
+        if since is None or since < 0:
+            abort (400)
+        try:
+            # Later changes wait for the next sync, whatever is committed while streaming
+            until = changes.latest_version()
+            # Deletes since then may have been pruned, the client must sync from 0 again
+            is_pruned = 0 < since < changes.pruned_version()
+        except:
+            print(sys.exc_info())
+            abort (500)
+        if is_pruned:
+            abort (410)
+        rows = changes.question_changes(since, until, app.config['EXPORT_BATCH_SIZE'], serializer)
+        response = app.response_class(stream_with_context(rows), mimetype=bulk.NDJSON_MIMETYPES[0])
+        response.headers[changes.VERSION_HEADER] = str(until)
+        return response
+
+
     @app.route('/questions/search', methods=['POST'])
+    @response_cache.cached(lambda: [versions.get('question')[0]])
     def search_questions():
         body = request.get_json()
         # Validate request
         schema = SearchQuestionRequestSchema()
         try:
-            # Validate request body against schema data types
-            schema.load(body)
+            # Validate request body against schema data types, e.g. "true" as True
+            data = schema.load(body)
         except ValidationError:
             print(sys.exc_info())
             abort (400)
         # Get search term
-        search_term = body.get('searchTerm')
+        search_term = data['searchTerm']
+        include_answers = data.get('includeAnswers', False)
         # Query to find matched questions
+        scope = f'search:{include_answers}:{search_term}'
         try:
-            questions = Question.query.filter(Question.question.ilike(f'%{search_term}%')).all()
-            current_questions = paginate_questions(request, questions)
+            if serving_snapshot():
+                # Matches are listed by id, without the Postgres ranking
+                current_questions, total_questions, next_cursor = paginate_snapshot(
+                    request, snapshot, scope=scope,
+                    ids=question_search.match_ids(search_term, include_answers))
+            else:
+                questions, ranking, total_questions = question_search.filter(
+                    Question.query, search_term, include_answers)
+                current_questions, total_questions, next_cursor = paginate_questions(
+                    request, questions, scope=scope,
+                    total_questions=total_questions, ranking=ranking)
+        except (BadSignature, InvalidProjection):
+            print(sys.exc_info())
+            abort (400)
         except:
             print(sys.exc_info())
             abort (500)
-        return jsonify({
+        return json_response({
             'success': True,
             'questions': current_questions,
-            'total_questions': len(questions),
+            'total_questions': total_questions,
+            'next_cursor': next_cursor,
+        })
+
+
+    @app.route('/questions/suggest')
+    def suggest_questions():
+        prefix = request.args.get('prefix')
+        if prefix is None:
+            abort (400)
+        limit = request.args.get('limit', app.config['SUGGEST_LIMIT'], type=int)
+        limit = min(max(limit, 1), app.config['SUGGEST_MAX_LIMIT'])
+        try:
+            suggestions = suggest_index.suggest(prefix, limit)
+        except:
+            print(sys.exc_info())
+            abort (500)
+        return json_response({
+            'success': True,
+            'suggestions': [
+                {'id': question_id, 'question': question}
+                for question_id, question in suggestions
+            ],
         })
 
 
     @app.route('/categories/<int:category_id>/questions')
+    @conditional(lambda category_id: [versions.get('question', category_id)])
+    @response_cache.cached(lambda category_id: [versions.get('question', category_id)[0]])
     def questions_by_category(category_id):
         try:
-            retrieved_questions = Question.query.filter(Question.category == category_id).all()
+            if serving_snapshot():
+                current_questions, total_questions, next_cursor = paginate_snapshot(
+                    request, snapshot, scope=category_id, category_id=category_id)
+            else:
+                questions = Question.query.filter(Question.category == category_id)
+                current_questions, total_questions, next_cursor = paginate_questions(
+                    request, questions, scope=category_id,
+                    total_questions=question_counts.category(category_id))
+        except (BadSignature, InvalidProjection):
+            print(sys.exc_info())
+            abort (400)
         except:
             print(sys.exc_info())
             abort (500)
-        if len(retrieved_questions) == 0:
+        if len(current_questions) == 0:
             abort (404)
-        current_questions = paginate_questions(request, retrieved_questions)
 
-        return jsonify({
+        return json_response({
             'success': True,
             'questions': current_questions,
-            'total_questions': len(retrieved_questions),
+            'total_questions': total_questions,
+            'next_cursor': next_cursor,
+        })
+
+
+    @app.route('/cache/stats')
+    def get_cache_stats():
+        return json_response({
+            'success': True,
+            'caches': {
+                'categories': category_cache.stats(),
+                'responses': response_cache.stats(),
+                'suggest': suggest_index.stats(),
+                'snapshot': snapshot.stats() if snapshot else None,
+                'shared': shared.stats() if shared else None,
+                'changes': change_feed.stats() if change_feed else None,
+            },
         })
 
 
+    @app.route('/pool/stats')
+    def get_pool_stats():
+        replicas = app.extensions.get('replicas')
+        return json_response({
+            'success': True,
+            'pool': pool_stats(db.get_engine(app)),
+            'replicas': replicas.stats() if replicas else None,
+        })
+
+
+    @app.route('/metrics')
+    def get_metrics():
+        lines = instrumentation.render()
+        caches = {
+            'categories': category_cache.stats(),
+            'responses': response_cache.stats(),
+        }
+        lines += render_samples('trivia_cache_hits_total', 'Cache hits.', 'counter',
+                                [({'cache': name}, stats['hits']) for name, stats in caches.items()])
+        lines += render_samples('trivia_cache_misses_total', 'Cache misses.', 'counter',
+                                [({'cache': name}, stats['misses']) for name, stats in caches.items()])
+        pool = pool_stats(db.get_engine(app))
+        if pool is not None:
+            lines += render_samples('trivia_db_pool_checkouts_total', 'Connection checkouts.', 'counter',
+                                    [({}, pool['checkouts'])])
+            lines += render_samples('trivia_db_pool_in_use', 'Connections checked out.', 'gauge',
+                                    [({}, pool['in_use'])])
+            lines += render_samples('trivia_db_pool_overflows_total', 'Connections opened beyond the pool size.',
+                                    'counter', [({}, pool['overflows'])])
+            lines += render_samples('trivia_db_pool_timeouts_total', 'Checkouts that timed out.', 'counter',
+                                    [({}, pool['timeouts'])])
+        if snapshot is not None:
+            lines += render_samples('trivia_question_snapshot_bytes', 'Memory held by the question snapshot.',
+                                    'gauge', [({}, snapshot.stats()['bytes'])])
+        return app.response_class('\n'.join(lines) + '\n', content_type=PROMETHEUS_MIMETYPE)
+
+
     @app.route('/quizzes', methods=['POST'])
     def quiz():
         # Request input
@@ -202,34 +553,118 @@ def create_app(test_config=None):
         schema = QuizzesRequestSchema()
         try:
             # Validate request body against schema data types
-            schema.load(body)
+            data = schema.load(body)
         except ValidationError:
             print(sys.exc_info())
             abort (400)
         try:
-            # get the qestion category an the previous question
-            quiz_category = body.get('quiz_category')
-            category_id = quiz_category.get('id')
-            previous_questions = body.get('previous_questions')
-            # If id is set to zero, show questions of all categories
-            if category_id == 0:
-                questions = Question.query.filter(
-                    Question.id.notin_(previous_questions), 
-                ).all()
-            # Otherwise filter by category id
+            # get the qestion category an the previous question, as integers
+            category_id = data['quiz_category']['id']
+            previous_questions = data['previous_questions']
+            # Optional difficulty range and target distribution of difficulties
+            difficulty = data.get('difficulty')
+            difficulties = range(difficulty['min'], difficulty['max'] + 1) if difficulty else None
+            # Levels and weights deserialised as integers and floats
+            weights = data.get('difficulty_distribution') or None
+            count = data.get('count')
+            if count is None:
+                # Randomly pick an id (category 0 means all categories), then load that question only
+                question = None
+                while question is None:
+                    question_id = sampler.sample(category_id, previous_questions, difficulties, weights)
+                    if question_id is None:
+                        break
+                    if serving_snapshot():
+                        question = snapshot.get(question_id)
+                    else:
+                        row = Question.query.get(question_id)
+                        question = row.format() if row is not None else None
+                    if question is None:
+                        # Deleted by another process, draw again
+                        sampler.discard(question_id)
             else:
-                questions = Question.query.filter(
-                    Question.id.notin_(previous_questions), 
-                    Question.category == category_id
-                ).all()
-            # Randomly pick from the list
-            question = random.choice(questions)
+                # Draw a whole round of distinct ids, then load them with one query
+                question_ids = sampler.sample_many(
+                    category_id, previous_questions, min(count, app.config['QUIZ_MAX_COUNT']),
+                    difficulties, weights)
+                if serving_snapshot():
+                    questions_by_id = {question_id: snapshot.get(question_id) for question_id in question_ids}
+                else:
+                    rows = []
+                    if question_ids:
+                        rows = Question.query.with_entities(*Question.columns())\
+                            .filter(Question.id.in_(question_ids))\
+                            .all()
+                    questions_by_id = {row[0]: Question.format_row(row) for row in rows}
+                questions = []
+                for question_id in question_ids:
+                    if questions_by_id.get(question_id) is not None:
+                        questions.append(questions_by_id[question_id])
+                    else:
+                        sampler.discard(question_id)
+                question = questions[0] if questions else None
+        except:
+            print(sys.exc_info())
+            abort (500)
+        response = {
+            'success': True,
+            'question': question,
+        }
+        if count is not None:
+            response['questions'] = questions
+        return json_response(response)
+
+
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def create_quiz_session():
+        # Request input
+        body = request.get_json()
+        # Validate request
+        schema = QuizSessionRequestSchema()
+        try:
+            # Validate request body against schema data types
+            data = schema.load(body)
+        except ValidationError:
+            print(sys.exc_info())
+            abort (400)
+        try:
+            category_id = data['quiz_category']['id']
+            # The session permutes the ids of the category lazily
+            session_id, total_questions = quiz_sessions.create(sampler.question_ids(category_id))
+        except:
+            print(sys.exc_info())
+            abort (500)
+        return json_response({
+            'success': True,
+            'session_id': session_id,
+            'total_questions': total_questions,
+        })
+
+
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    def next_quiz_question(session_id):
+        try:
+            question = None
+            # Skip ids of questions deleted since the session started
+            while question is None:
+                question_id, remaining_questions = quiz_sessions.next_id(session_id)
+                if question_id is None:
+                    break
+                if serving_snapshot():
+                    question = snapshot.get(question_id)
+                else:
+                    question = Question.query.get(question_id)
+                    question = question.format() if question else None
+        except KeyError:
+            print(sys.exc_info())
+            abort (404)
         except:
             print(sys.exc_info())
             abort (500)
-        return jsonify({
+        return json_response({
             'success': True,
-            'question': question.format(),
+            'question': question,
+            'remaining_questions': remaining_questions,
         })
     
     return app
@@ -0,0 +1,175 @@
+import csv
+import io
+import json
+
+from marshmallow import ValidationError
+from sqlalchemy import exc
+
+from models.models import db, Question, QUESTION_FIELDS
+from models.request_schema import CreateQuestionRequestSchema
+
+EXPORT_FIELDS = QUESTION_FIELDS
+IMPORT_FIELDS = ['question', 'answer', 'category', 'difficulty']
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonlines')
+CSV_MIMETYPE = 'text/csv'
+# Reported for rows the database rejected, without the driver's message
+CONFLICT_MESSAGE = 'Conflicts with the stored questions or categories.'
+
+
+class ImportInterrupted(Exception):
+    """
+    Raised when an import stops on an unexpected error. `created` and
+    `errors` report the rows handled before it, and `row` is the first
+    row of the chunk that failed: rows from there on were not imported,
+    except those listed in `created`.
+    """
+
+    def __init__(self, created, errors, row):
+        super().__init__(f'Import interrupted at row {row}')
+        self.created = created
+        self.errors = errors
+        self.row = row
+
+
+"""
+read_ndjson(stream)
+    yields `(row_number, row)` for each non-blank line of a NDJSON
+    stream, `row` being None when the line is not a JSON object
+"""
+def read_ndjson(stream):
+    for row_number, line in enumerate(io.TextIOWrapper(stream, encoding='utf-8'), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield row_number, row if isinstance(row, dict) else None
+
+
+"""
+read_csv(stream)
+    yields `(row_number, row)` for each record of a CSV stream whose
+    header names the question fields
+"""
+def read_csv(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline=''))
+    for row_number, row in enumerate(reader, start=1):
+        yield row_number, {field: row.get(field) for field in IMPORT_FIELDS if row.get(field) is not None}
+
+
+"""
+chunked(rows, chunk_size)
+    groups an iterable into lists of at most chunk_size items
+"""
+def chunked(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+"""
+insert_rows(valid, created, errors)
+    inserts the `(row_number, question)` pairs of a chunk in one
+    transaction. When the database rejects it, inserts them one by one
+    to tell the rejected rows apart. Appends the ids of the created
+    questions to `created` and the rejected rows to `errors`
+"""
+def insert_rows(valid, created, errors):
+    try:
+        created += Question.insert_many([question for _, question in valid])
+        return
+    except exc.IntegrityError:
+        db.session.rollback()
+    for row_number, question in valid:
+        try:
+            created += Question.insert_many([question])
+        except exc.IntegrityError:
+            db.session.rollback()
+            errors.append({'row': row_number, 'messages': {'_schema': [CONFLICT_MESSAGE]}})
+
+
+"""
+import_chunk(chunk, categories, created, errors)
+    validates and inserts one chunk of `(row_number, row)` pairs,
+    appending the created ids to `created` and the row errors to `errors`
+"""
+def import_chunk(chunk, categories, created, errors):
+    # Reject rows that are not JSON objects before validating the rest
+    for row_number, row in chunk:
+        if row is None:
+            errors.append({'row': row_number, 'messages': {'_schema': ['Invalid row.']}})
+    chunk = [(row_number, row) for row_number, row in chunk if row is not None]
+
+    schema = CreateQuestionRequestSchema(many=True)
+    try:
+        questions = schema.load([row for _, row in chunk])
+    except ValidationError as err:
+        for index, messages in err.messages.items():
+            errors.append({'row': chunk[index][0], 'messages': messages})
+        chunk = [pair for index, pair in enumerate(chunk) if index not in err.messages]
+        questions = schema.load([row for _, row in chunk])
+
+    valid = []
+    for (row_number, _), question in zip(chunk, questions):
+        if question['category'] not in categories:
+            errors.append({'row': row_number, 'messages': {'category': ['Unknown category.']}})
+        else:
+            valid.append((row_number, question))
+    if valid:
+        insert_rows(valid, created, errors)
+
+
+"""
+import_questions(rows, categories, chunk_size)
+    validates and inserts `(row_number, row)` pairs chunk by chunk, one
+    transaction per chunk, and returns the ids of the created questions
+    with the list of per-row errors. Any other error raises
+    ImportInterrupted, reporting what was committed before it
+"""
+def import_questions(rows, categories, chunk_size):
+    created, errors = [], []
+    row_number = 1
+    try:
+        for chunk in chunked(rows, chunk_size):
+            row_number = chunk[0][0]
+            import_chunk(chunk, categories, created, errors)
+    except Exception as err:
+        db.session.rollback()
+        errors.sort(key=lambda error: error['row'])
+        raise ImportInterrupted(created, errors, row_number) from err
+    errors.sort(key=lambda error: error['row'])
+    return created, errors
+
+
+"""
+export_questions(export_format, batch_size, serializer)
+    yields every question serialised as NDJSON lines (encoded with
+    `serializer`) or CSV records, reading them through a server-side
+    cursor `batch_size` rows at a time
+"""
+def export_questions(export_format, batch_size, serializer):
+    rows = Question.query\
+        .with_entities(*[getattr(Question, field) for field in EXPORT_FIELDS])\
+        .order_by(Question.id)\
+        .execution_options(stream_results=True)\
+        .yield_per(batch_size)
+
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        yield buffer.getvalue()
+        for batch in chunked(rows, batch_size):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(batch)
+            yield buffer.getvalue()
+    else:
+        for batch in chunked(rows, batch_size):
+            yield b''.join(serializer.dumps(dict(zip(EXPORT_FIELDS, row))) + b'\n' for row in batch)
@@ -0,0 +1,215 @@
+import hashlib
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import current_app, request, make_response
+
+from models.models import Category
+
+# `digest` identifies the body and `modified` is when it last changed
+CachedCategories = namedtuple('CachedCategories', ['categories', 'body', 'digest', 'modified'])
+# Name of the GET /categories body in the shared payloads
+CATEGORIES_PAYLOAD = 'categories'
+
+
+"""
+query_categories()
+    returns the `{id: type}` map of every category
+"""
+def query_categories():
+    return {category.id: category.type for category in Category.query.order_by(Category.id).all()}
+
+
+"""
+categories_body(serializer, categories)
+    serialises the GET /categories response of a category map
+"""
+def categories_body(serializer, categories):
+    return serializer.dumps({
+        'success': True,
+        'categories': categories,
+        'total_categories': len(categories),
+    })
+
+
+class CategoryCache:
+    """
+    Caches the category map shared by GET /categories and GET /questions.
+
+    Holds both the `{id: type}` dict and the serialised body of the
+    GET /categories response, so a hit costs neither a database
+    round-trip nor a JSON encoding. Entries expire after `ttl` seconds
+    and can be dropped at any time with invalidate(), or by passing the
+    current `version` of the categories to get(). With `shared` payloads,
+    misses copy the body published by another worker while it is fresh
+    instead of querying the database.
+    """
+
+    def __init__(self, ttl, serializer, shared=None):
+        self.ttl = ttl
+        self.serializer = serializer
+        self.shared = shared
+        self.entry = None
+        self.version = None
+        self.expires_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, version=None):
+        """Return the cached categories, reloaded if older than `version`."""
+        with self.lock:
+            if self.entry is not None and time.monotonic() < self.expires_at and \
+                    (version is None or version == self.version):
+                self.hits += 1
+                return self.entry
+            self.misses += 1
+
+        payload = self.shared.get(CATEGORIES_PAYLOAD) if self.shared is not None else None
+        if payload is not None:
+            categories_dict = {
+                int(category_id): category_type
+                for category_id, category_type in self.serializer.loads(payload)['categories'].items()
+            }
+            # The cached body outlives the mapping, which a publication replaces
+            body = bytes(payload)
+        else:
+            categories_dict = query_categories()
+            body = categories_body(self.serializer, categories_dict)
+        digest = hashlib.sha1(body).hexdigest()
+        previous = self.entry
+        if previous is not None and previous.digest == digest:
+            modified = previous.modified
+        else:
+            modified = datetime.now(timezone.utc).replace(microsecond=0)
+        entry = CachedCategories(categories_dict, body, digest, modified)
+        # Do not cache an empty table, categories may be seeded later
+        if len(categories_dict):
+            with self.lock:
+                self.entry = entry
+                self.version = version
+                self.expires_at = time.monotonic() + self.ttl
+        return entry
+
+    def invalidate(self):
+        with self.lock:
+            self.entry = None
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'cached': self.entry is not None,
+        }
+
+
+class InMemoryLRUBackend:
+    """
+    Response cache backend bounded by the total size of its values.
+
+    Least recently used entries are evicted once `max_bytes` is exceeded.
+    Any object exposing the same get/set/stats methods can be passed as
+    RESPONSE_CACHE_BACKEND to share the cache through an external store.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._discard(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            if key in self.entries:
+                self._discard(key)
+            # A value larger than the whole cache is not worth evicting everything for
+            if len(value) > self.max_bytes:
+                return
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _discard(self, key):
+        _, value = self.entries.pop(key)
+        self.size -= len(value)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'evictions': self.evictions,
+        }
+
+
+class ResponseCache:
+    """
+    Caches serialised JSON responses keyed by route, arguments and body.
+
+    Keys also embed the version tags of the resources a response depends
+    on (see ResourceVersions), so a question write makes every cached page
+    of its category, or of all questions, unreachable at once. Stale
+    entries are then aged out by the backend.
+    """
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, tags):
+        digest = hashlib.sha1()
+        digest.update(request.path.encode('utf-8'))
+        digest.update(request.query_string)
+        digest.update(hashlib.sha1(request.get_data()).digest())
+        digest.update('/'.join(tags).encode('utf-8'))
+        return digest.hexdigest()
+
+    def cached(self, tags):
+        """
+        Decorates a view returning JSON so that its 200 responses are
+        served from the cache. `tags(**view_args)` returns the version
+        tags of the resources the response depends on.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**view_args):
+                key = self.key(tags(**view_args))
+                body = self.backend.get(key)
+                if body is not None:
+                    self.hits += 1
+                    return current_app.response_class(body, mimetype='application/json')
+                self.misses += 1
+                response = make_response(view(**view_args))
+                if response.status_code == 200 and response.is_json:
+                    self.backend.set(key, response.get_data(), self.ttl)
+                return response
+            return wrapper
+        return decorator
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0,
+            **self.backend.stats(),
+        }
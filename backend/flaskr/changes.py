@@ -0,0 +1,272 @@
+"""
+Change feed
+
+Keeps the in-process caches and indexes of every process, on every host,
+coherent with the writes made by the others. Triggers log each write to
+questions and categories in the `changes` table (see models.migrations)
+and, on Postgres, notify it. A background thread per app LISTENs to the
+notifications, or polls the table on other databases, and applies each
+change exactly once, in version order, through the question and category
+listeners the local writes already go through.
+"""
+import json
+import select
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import DateTime, bindparam, func, text
+
+from models.models import db, Change
+from models.migrations import CHANGES_CHANNEL
+
+LISTEN = 'listen'
+POLL = 'poll'
+# Changes read per query while catching up
+BATCH_SIZE = 500
+# Response header of GET /questions/changes, the `since` of the next sync
+VERSION_HEADER = 'X-Changes-Version'
+# Last version pruned from the changes, 0 when none was
+PRUNED_VERSION = text("SELECT coalesce(max(pruned_version), 0) FROM changes_retention")
+
+
+class ChangeFeed:
+    """
+    Follows the changes table from a background thread.
+
+    In 'listen' mode on Postgres, notifications carrying the next version
+    are applied from their payload without any query; a gap in the
+    versions (a rolled back write, a payload too large, a reconnection)
+    is filled from the table. In 'poll' mode, or on other databases, the
+    table is read every `poll_interval` seconds. Local writes apply the
+    pending changes right after their commit (see notify_question_changes),
+    so a process always reads its own writes. A feed left behind the
+    changes pruned by prune_changes() calls `resync()` to rebuild its
+    caches from the tables, then follows the changes from there.
+    """
+
+    def __init__(self, app, mode, poll_interval, resync=None):
+        self.app = app
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.resync = resync
+        self.version = None
+        self.applied = 0
+        self.notifications = 0
+        self.errors = 0
+        self.listener_errors = 0
+        self.resyncs = 0
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def listens(self):
+        return self.mode == LISTEN and db.get_engine(self.app).dialect.name == 'postgresql'
+
+    def current_version(self):
+        """Return the version of the last change committed."""
+        with db.get_engine(self.app).connect() as connection:
+            return connection.execute(text("SELECT coalesce(max(version), 0) FROM changes")).scalar()
+
+    def start(self, since):
+        """Follow the changes made after version `since` from a background thread."""
+        self.version = since
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='change-feed', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                with self.app.app_context():
+                    if self.listens:
+                        self.listen()
+                    else:
+                        while not self.stopped.wait(self.poll_interval):
+                            self.poll()
+            except:
+                # Lost the database, catch up once it is back
+                print(sys.exc_info())
+                self.errors += 1
+                self.stopped.wait(self.poll_interval)
+
+    def listen(self):
+        # A connection of its own, outside the pool: it stays idle in LISTEN
+        engine = db.get_engine(self.app)
+        connect_args, connect_kwargs = engine.dialect.create_connect_args(engine.url)
+        connection = engine.dialect.connect(*connect_args, **connect_kwargs)
+        try:
+            connection.autocommit = True
+            connection.cursor().execute(f'LISTEN {CHANGES_CHANNEL}')
+            # Changes committed before LISTEN were not notified
+            self.poll()
+            while not self.stopped.is_set():
+                readable, _, _ = select.select([connection], [], [], self.poll_interval)
+                if not readable:
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    self.notifications += 1
+                    self.receive(json.loads(notify.payload))
+        finally:
+            connection.close()
+
+    def receive(self, change):
+        """Apply a notified change, reading the table when versions were skipped."""
+        with self.lock:
+            if change['version'] <= self.version:
+                return
+            if change['version'] == self.version + 1 and 'data' in change:
+                self.apply([(change['version'], change['entity'], change['action'], change['data'])])
+                return
+        self.poll()
+
+    def catch_up(self, version):
+        """Apply the changes up to `version` now, unless they were already."""
+        if self.version is not None and self.version < version:
+            self.poll()
+
+    def poll(self):
+        """Apply every change committed after the last one applied."""
+        with self.lock:
+            with db.get_engine(self.app).connect() as connection:
+                behind = self.version < connection.execute(PRUNED_VERSION).scalar()
+            if behind:
+                # Deletes this feed did not apply are gone from the log
+                version = self.current_version()
+                if self.resync is not None:
+                    self.resync()
+                self.version = version
+                self.resyncs += 1
+            while True:
+                with db.get_engine(self.app).connect() as connection:
+                    rows = connection.execute(text(
+                        "SELECT version, entity, action, data FROM changes "
+                        "WHERE version > :version ORDER BY version LIMIT :limit"
+                    ), version=self.version, limit=BATCH_SIZE).fetchall()
+                self.apply([(version, entity, action, json.loads(data)) for version, entity, action, data in rows])
+                if len(rows) < BATCH_SIZE:
+                    return
+
+    def apply(self, changes):
+        listeners = {
+            'question': self.app.extensions.get('question_listeners', []),
+            'category': self.app.extensions.get('category_listeners', []),
+        }
+        for version, entity, action, data in changes:
+            for listener in listeners.get(entity, []):
+                # A failing listener must not hold back the changes after this one
+                try:
+                    listener(action, data)
+                except:
+                    print(sys.exc_info())
+                    self.listener_errors += 1
+            self.version = version
+            self.applied += 1
+
+    def stats(self):
+        return {
+            'mode': LISTEN if self.listens else POLL,
+            'running': self.is_running,
+            'version': self.version,
+            'applied': self.applied,
+            'notifications': self.notifications,
+            'errors': self.errors,
+            'listener_errors': self.listener_errors,
+            'resyncs': self.resyncs,
+        }
+
+
+"""
+pruned_version()
+    returns the low-water mark of the changes: tombstones and superseded
+    changes up to this version may have been pruned
+"""
+def pruned_version():
+    return db.session.execute(PRUNED_VERSION).scalar()
+
+
+"""
+prune_changes(retention_seconds)
+    deletes the changes older than `retention_seconds` that nobody needs to
+    rebuild the current rows: tombstones, and changes superseded by a later
+    change of the same row. The last change of every row is kept, so that
+    syncing from version 0 still returns every question. Records the last
+    version considered as the low-water mark, which moves the validators
+    of the read endpoints forward, and returns the number of changes
+    deleted
+"""
+def prune_changes(retention_seconds):
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=retention_seconds)
+    with db.get_engine().begin() as connection:
+        mark = connection.execute(
+            text("SELECT max(version) FROM changes WHERE changed_at < :cutoff")
+            .bindparams(bindparam('cutoff', type_=DateTime(timezone=True))),
+            cutoff=cutoff,
+        ).scalar()
+        if mark is None:
+            return 0
+        deleted = connection.execute(text(
+            "DELETE FROM changes WHERE version <= :mark AND (action = 'delete' OR EXISTS ("
+            "SELECT 1 FROM changes AS later WHERE later.entity = changes.entity "
+            "AND later.entity_id = changes.entity_id AND later.version > changes.version))"
+        ), mark=mark).rowcount
+        connection.execute(
+            text("INSERT INTO changes_retention (pruned_version, pruned_at) VALUES (:mark, :pruned_at)")
+            .bindparams(bindparam('pruned_at', type_=DateTime(timezone=True))),
+            mark=mark, pruned_at=datetime.now(timezone.utc),
+        )
+    return deleted
+
+
+"""
+latest_version()
+    returns the version of the last change committed, 0 when there is none
+"""
+def latest_version():
+    return Change.query.with_entities(func.coalesce(func.max(Change.version), 0)).scalar()
+
+
+"""
+question_changes(since, until, batch_size, serializer)
+    yields as NDJSON lines the questions changed after version `since`, up
+    to version `until`, in version order. Only the last change of each
+    question is sent: its current state, or a tombstone with its id when
+    it was deleted. Rows are read through a server-side cursor
+    `batch_size` at a time
+"""
+def question_changes(since, until, batch_size, serializer):
+    last_changes = Change.query\
+        .with_entities(func.max(Change.version))\
+        .filter(Change.entity == 'question', Change.version > since, Change.version <= until)\
+        .group_by(Change.entity_id)
+    rows = Change.query\
+        .with_entities(Change.version, Change.action, Change.entity_id, Change.data)\
+        .filter(Change.version.in_(last_changes))\
+        .order_by(Change.version)\
+        .execution_options(stream_results=True)\
+        .yield_per(batch_size)
+
+    batch = []
+    for version, action, question_id, data in rows:
+        if action == 'delete':
+            change = {'version': version, 'action': 'delete', 'id': question_id}
+        else:
+            change = {'version': version, 'action': 'upsert', 'question': serializer.loads(data)}
+        batch.append(serializer.dumps(change) + b'\n')
+        if len(batch) == batch_size:
+            yield b''.join(batch)
+            batch = []
+    if batch:
+        yield b''.join(batch)
@@ -0,0 +1,124 @@
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import current_app, g, request, make_response
+
+from sqlalchemy import BigInteger, DateTime, text
+
+from models.models import db
+
+DEFAULT_CACHE_CONTROL = 'no-cache'
+# Last-Modified date of an entity never written since the changes log exists
+UNCHANGED_SINCE = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Last pruning of the changes log. It is part of every validator: pruning may
+# delete the last change of an entity or category, whose version must not go back
+LAST_PRUNE = (
+    "UNION ALL SELECT pruned_version, pruned_at FROM ("
+    "SELECT pruned_version, pruned_at FROM changes_retention "
+    "ORDER BY pruned_version DESC LIMIT 1) AS last_prune "
+    "ORDER BY version DESC, changed_at DESC LIMIT 1"
+)
+# Served by ix_changes_entity_version. Plain text, as it runs on every conditional request
+LAST_CHANGE = text(
+    "SELECT version, changed_at FROM ("
+    "SELECT version, changed_at FROM changes WHERE entity = :entity "
+    "ORDER BY version DESC LIMIT 1) AS last_change " + LAST_PRUNE
+).columns(version=BigInteger, changed_at=DateTime(timezone=True))
+# Last change adding, editing or removing a question of a category, served by
+# ix_changes_category and ix_changes_previous_category
+CATEGORY_LAST_CHANGE = text(
+    "SELECT version, changed_at FROM ("
+    "SELECT version, changed_at FROM changes WHERE category = :category "
+    "ORDER BY version DESC LIMIT 1) AS current_category "
+    "UNION ALL SELECT version, changed_at FROM ("
+    "SELECT version, changed_at FROM changes WHERE previous_category = :category "
+    "ORDER BY version DESC LIMIT 1) AS previous_category " + LAST_PRUNE
+).columns(version=BigInteger, changed_at=DateTime(timezone=True))
+
+
+class ResourceVersions:
+    """
+    Validators of the questions and categories served by the read endpoints.
+
+    They are read from the changes log (see models.migrations), which the
+    triggers write for every process and host: the tag of an entity is the
+    version of its last change and its Last-Modified date the time of that
+    change. Every worker hands out, and accepts, the same validators, and
+    none of them answers 304 for a write it did not make. Each validator
+    costs one statement of indexed `ORDER BY version DESC LIMIT 1` per
+    request. The questions of a category have their own validator, which
+    only changes with a write to one of them, a question moved in or
+    out, or a pruning of the log.
+
+    The pages are built from in-process state too (counters, snapshot),
+    so `sync(entity, version)` is called with each version read, before
+    any response is built or cached under it, to bring that state up to
+    the version.
+    """
+
+    def __init__(self, sync=None):
+        self.sync = sync
+
+    def get(self, entity, category=None):
+        """
+        Return the `(tag, last_modified)` validator of 'question' or
+        'category', or of the questions of `category`.
+        """
+        key = f'{entity}_validator' if category is None else f'{entity}_{category}_validator'
+        if key not in g:
+            if category is None:
+                row = db.session.execute(LAST_CHANGE, {'entity': entity}).first()
+            else:
+                row = db.session.execute(CATEGORY_LAST_CHANGE, {'category': category}).first()
+            if row is None:
+                validator = ('0', UNCHANGED_SINCE)
+            else:
+                version, changed_at = row
+                # SQLite returns naive UTC times
+                if changed_at.tzinfo is None:
+                    changed_at = changed_at.replace(tzinfo=timezone.utc)
+                validator = (str(version), changed_at.astimezone(timezone.utc).replace(microsecond=0))
+            if self.sync is not None:
+                self.sync(entity, int(validator[0]))
+            setattr(g, key, validator)
+        return getattr(g, key)
+
+
+"""
+conditional(validators)
+    decorates a GET view so that it answers 304 Not Modified, without
+    running the view, when the client copy is still fresh.
+    `validators(**view_args)` returns the `(tag, last_modified)` pairs of
+    the resources the response depends on; they make up a strong ETag and
+    the Last-Modified date. Cache-Control comes from the CACHE_CONTROL
+    config, by endpoint name.
+"""
+def conditional(validators):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**view_args):
+            parts = validators(**view_args)
+            etag = hashlib.sha1('/'.join(tag for tag, _ in parts).encode('utf-8')).hexdigest()[:32]
+            last_modified = max(modified for _, modified in parts)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                # Werkzeug may parse the header as a naive UTC datetime
+                not_modified = request.if_modified_since is not None and \
+                    request.if_modified_since.replace(tzinfo=None) >= last_modified.replace(tzinfo=None)
+
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(**view_args))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.headers['Cache-Control'] = current_app.config['CACHE_CONTROL']\
+                .get(request.endpoint, DEFAULT_CACHE_CONTROL)
+            return response
+        return wrapper
+    return decorator
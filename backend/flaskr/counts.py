@@ -0,0 +1,76 @@
+import sys
+import threading
+import time
+
+from sqlalchemy import func
+
+from models.models import Question
+
+
+class QuestionCounts:
+    """
+    Keeps the number of questions per category in memory.
+
+    The counters are loaded with a single `SELECT category, COUNT(*)
+    GROUP BY category`, adjusted by the question listener on every insert
+    and delete, and reconciled with the database every
+    `reconcile_interval` seconds to absorb writes made by other processes.
+    Questions without a category (e.g. after their category was deleted)
+    are counted under None. When a reconciliation fails, the last known
+    counters are served until the database is back. Without a change
+    feed, sync() also reconciles them whenever the version of the
+    questions in the changes log moves.
+    """
+
+    def __init__(self, reconcile_interval):
+        self.reconcile_interval = reconcile_interval
+        self.by_category = None
+        self.reconciled_at = 0
+        self.synced_version = None
+        self.lock = threading.Lock()
+
+    def reconcile(self):
+        rows = Question.query\
+            .with_entities(Question.category, func.count(Question.id))\
+            .group_by(Question.category)\
+            .all()
+        with self.lock:
+            self.by_category = {category: count for category, count in rows}
+            self.reconciled_at = time.monotonic()
+
+    def sync(self, version):
+        """Reconcile the counters once for each newer `version` of the questions."""
+        if self.synced_version is None or version > self.synced_version:
+            self.reconcile()
+            self.synced_version = version
+
+    def _counts(self):
+        if self.by_category is None or \
+                time.monotonic() - self.reconciled_at > self.reconcile_interval:
+            try:
+                self.reconcile()
+            except:
+                if self.by_category is None:
+                    raise
+                print(sys.exc_info())
+        return self.by_category
+
+    def total(self):
+        return sum(self._counts().values())
+
+    def category(self, category_id):
+        return self._counts().get(category_id, 0)
+
+    def on_question_change(self, action, question):
+        """Question listener adjusting the counters after each write."""
+        with self.lock:
+            if self.by_category is None:
+                return
+            category = question['category']
+            if action == 'insert':
+                self.by_category[category] = self.by_category.get(category, 0) + 1
+            elif action == 'delete':
+                self.by_category[category] = self.by_category.get(category, 1) - 1
+            else:
+                # The previous category is unknown, reconcile on next read
+                self.reconciled_at = 0
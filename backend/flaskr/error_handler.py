@@ -22,6 +22,15 @@ def page_not_found(error):
     }), 404
 
 
+@blueprint.app_errorhandler(410)
+def gone(error):
+    return jsonify({
+        "success": False,
+        'error': 410,
+        "message": "Gone"
+    }), 410
+
+
 @blueprint.app_errorhandler(422)
 def unprocessable_entity(error):
     return jsonify({
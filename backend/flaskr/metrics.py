@@ -0,0 +1,205 @@
+import bisect
+import json
+import logging
+import threading
+import time
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+logger = logging.getLogger('trivia.requests')
+
+
+class Histogram:
+    """Prometheus histogram with one series per tuple of label values."""
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                # One count per bucket, plus +Inf, then the sum
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {values[-1]}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+"""
+render_samples(name, description, metric_type, samples)
+    renders `(labels dict, value)` samples of a counter or gauge in the
+    Prometheus text format
+"""
+def render_samples(name, description, metric_type, samples):
+    lines = [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}']
+    for labels, value in samples:
+        labels = ','.join(f'{key}="{label}"' for key, label in labels.items())
+        lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+    return lines
+
+
+class CountingCursor:
+    """DBAPI cursor adding the number of rows fetched through it to `measures['rows']`."""
+
+    def __init__(self, cursor, measures):
+        self.cursor = cursor
+        self.measures = measures
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.measures['rows'] += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self.measures['rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.measures['rows'] += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class Instrumentation:
+    """
+    Request and SQL metrics of an app.
+
+    Every request is timed and logged as one JSON line with its number
+    of SQL queries, their duration, the rows fetched from them and the
+    response size. The same measures feed the histograms served by
+    GET /metrics. SQL statements are timed by engine events, so queries
+    outside a request (warm-ups, background threads) are only counted in
+    the per-statement histogram.
+    """
+
+    def __init__(self, slow_query_seconds, query_count_warning):
+        self.slow_query_seconds = slow_query_seconds
+        self.query_count_warning = query_count_warning
+        self.request_duration = Histogram(
+            'trivia_request_duration_seconds', 'Request latency.',
+            ('endpoint', 'method', 'status'), LATENCY_BUCKETS)
+        self.request_queries = Histogram(
+            'trivia_request_queries', 'SQL queries run per request.',
+            ('endpoint',), COUNT_BUCKETS)
+        self.request_rows = Histogram(
+            'trivia_request_rows', 'Rows fetched from the SQL queries of a request.',
+            ('endpoint',), ROW_BUCKETS)
+        self.response_bytes = Histogram(
+            'trivia_response_bytes', 'Size of the response bodies.',
+            ('endpoint',), BYTE_BUCKETS)
+        self.query_duration = Histogram(
+            'trivia_sql_query_duration_seconds', 'SQL statement latency.',
+            ('statement',), LATENCY_BUCKETS)
+
+    def start_request(self):
+        g.metrics = {'start': time.perf_counter(), 'queries': 0, 'query_seconds': 0, 'rows': 0}
+
+    def end_request(self, response):
+        measures = g.pop('metrics', None)
+        if measures is None:
+            return response
+        duration = time.perf_counter() - measures['start']
+        endpoint = request.endpoint or 'unmatched'
+        # Streamed responses have no length until they are sent
+        size = response.content_length
+
+        self.request_duration.observe((endpoint, request.method, str(response.status_code)), duration)
+        self.request_queries.observe((endpoint,), measures['queries'])
+        self.request_rows.observe((endpoint,), measures['rows'])
+        if size is not None:
+            self.response_bytes.observe((endpoint,), size)
+
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': endpoint,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 3),
+            'queries': measures['queries'],
+            'query_ms': round(measures['query_seconds'] * 1000, 3),
+            'rows': measures['rows'],
+            'bytes': size,
+        }
+        if measures['queries'] > self.query_count_warning:
+            logger.warning(json.dumps(dict(record, warning='too many queries')))
+        else:
+            logger.info(json.dumps(record))
+        return response
+
+    def observe_query(self, statement, duration, context):
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'EMPTY'
+        self.query_duration.observe((verb,), duration)
+        measures = g.get('metrics')
+        if measures is not None:
+            measures['queries'] += 1
+            measures['query_seconds'] += duration
+            # cursor.rowcount is -1 for the SELECTs of sqlite3 and of
+            # server-side cursors, and counts the rows a write affected:
+            # results fetch through a proxy counting the rows they return
+            context.cursor = CountingCursor(context.cursor, measures)
+        if duration >= self.slow_query_seconds:
+            logger.warning(json.dumps({
+                'slow_query': statement,
+                'duration_ms': round(duration * 1000, 3),
+            }))
+
+    def render(self):
+        lines = []
+        for histogram in (self.request_duration, self.request_queries, self.request_rows,
+                          self.response_bytes, self.query_duration):
+            lines += histogram.render()
+        return lines
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    # Engines are shared by apps, measures go to the app running the query
+    if has_app_context() and 'metrics' in current_app.extensions:
+        current_app.extensions['metrics'].observe_query(
+            statement, time.perf_counter() - start, context)
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    # Failed statements never reach after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
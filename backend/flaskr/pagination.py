@@ -0,0 +1,166 @@
+from flask import current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import func
+
+from models.models import Question, QUESTION_FIELDS
+
+CURSOR_SALT = 'questions-cursor'
+
+
+class InvalidProjection(ValueError):
+    """Raised when `fields` names a column questions do not have."""
+
+
+"""
+cursor_serializer()
+    signs and verifies continuation tokens with the app SECRET_KEY
+"""
+def cursor_serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt=CURSOR_SALT)
+
+
+"""
+encode_cursor(last_id, scope)
+    builds an opaque token pointing right after `last_id` in the listing
+    identified by `scope` (e.g. a category id, or None for all questions)
+"""
+def encode_cursor(last_id, scope=None):
+    return cursor_serializer().dumps({'id': last_id, 'scope': scope})
+
+
+"""
+encode_offset_cursor(offset, scope)
+    builds an opaque token pointing at the `offset`-th row of a ranked
+    listing, which cannot be resumed from an id
+"""
+def encode_offset_cursor(offset, scope=None):
+    return cursor_serializer().dumps({'offset': offset, 'scope': scope})
+
+
+"""
+decode_cursor(cursor, scope)
+    returns the position stored in `cursor` (`id` or `offset`), raising
+    BadSignature if the token was tampered with or belongs to another listing
+"""
+def decode_cursor(cursor, scope=None):
+    payload = cursor_serializer().loads(cursor)
+    if not isinstance(payload, dict) or payload.get('scope') != scope:
+        raise BadSignature('Cursor does not belong to this listing.')
+    return payload
+
+
+"""
+page_size(request)
+    returns the `per_page` argument bounded by MAX_QUESTIONS_PER_PAGE,
+    QUESTIONS_PER_PAGE when missing
+"""
+def page_size(request):
+    per_page = request.args.get('per_page', current_app.config['QUESTIONS_PER_PAGE'], type=int)
+    return min(max(per_page, 1), current_app.config['MAX_QUESTIONS_PER_PAGE'])
+
+
+"""
+projection(request)
+    returns the question fields listed in the comma separated `fields`
+    argument, every field when missing. Raises InvalidProjection for
+    unknown fields
+"""
+def projection(request):
+    fields = request.args.get('fields')
+    if fields is None:
+        return QUESTION_FIELDS
+    requested = {field.strip() for field in fields.split(',') if field.strip()}
+    if not requested or not requested <= set(QUESTION_FIELDS):
+        raise InvalidProjection(f'Unknown question fields {fields!r}.')
+    return [field for field in QUESTION_FIELDS if field in requested]
+
+
+"""
+paginate_questions(request, query, scope, total_questions, ranking)
+    slices a question query in SQL and returns the current page of
+    formatted questions, the total number of matching rows and a
+    `next_cursor` token (None on the last page). The total is counted
+    with a COUNT query unless `total_questions` is already known.
+    By default the page is selected with LIMIT/OFFSET from the `page`
+    argument. Passing `cursor` (or a plain `after_id`) switches to keyset
+    pagination, which resumes with `WHERE id > :last ORDER BY id` so deep
+    pages cost the same as the first one.
+    Listings ordered by a `ranking` expression (best first) always use
+    LIMIT/OFFSET, their cursors carry the offset of the next page.
+    Pages hold `per_page` questions (see page_size()) and only the
+    columns named by `fields` (see projection()) are selected.
+"""
+def paginate_questions(request, query, scope=None, total_questions=None, ranking=None):
+    if total_questions is None:
+        total_questions = query.order_by(None)\
+            .with_entities(func.count(Question.id))\
+            .scalar()
+
+    per_page = page_size(request)
+    fields = projection(request)
+    cursor = request.args.get('cursor')
+    position = decode_cursor(cursor, scope) if cursor is not None else {}
+    after_id = position.get('id', request.args.get('after_id', type=int))
+
+    if ranking is None and after_id is not None:
+        offset = None
+        query = query.filter(Question.id > after_id).order_by(Question.id)
+    else:
+        if 'offset' in position:
+            offset = position['offset']
+        else:
+            page = max(request.args.get('page', 1, type=int), 1)
+            offset = (page - 1) * per_page
+        if ranking is not None:
+            query = query.order_by(ranking.desc(), Question.id)
+        else:
+            query = query.order_by(Question.id)
+        query = query.offset(offset)
+
+    # Fetch one extra row to know whether there is a next page
+    # Plain column tuples are much cheaper to load than ORM instances. The
+    # id comes first whatever the projection, the next cursor points after it
+    columns = ['id'] + [field for field in fields if field != 'id']
+    selection = query.with_entities(*Question.columns(columns)).limit(per_page + 1).all()
+    has_next = len(selection) > per_page
+    selection = selection[:per_page]
+
+    current_questions = [
+        {field: value for field, value in zip(columns, row) if field in fields}
+        for row in selection
+    ]
+    next_cursor = None
+    if has_next and ranking is not None:
+        next_cursor = encode_offset_cursor(offset + per_page, scope)
+    elif has_next:
+        next_cursor = encode_cursor(selection[-1][0], scope)
+    return current_questions, total_questions, next_cursor
+
+
+"""
+paginate_snapshot(request, snapshot, scope, category_id, ids)
+    pages through a QuestionSnapshot with the same arguments, cursors and
+    results as paginate_questions(), ordered by id. `category_id` or the
+    set of `ids` restrict the listing. Cursors always carry the last id,
+    offset cursors of ranked listings are still accepted
+"""
+def paginate_snapshot(request, snapshot, scope=None, category_id=None, ids=None):
+    total_questions = len(ids) if ids is not None else snapshot.count(category_id)
+
+    per_page = page_size(request)
+    fields = projection(request)
+    cursor = request.args.get('cursor')
+    position = decode_cursor(cursor, scope) if cursor is not None else {}
+    after_id = position.get('id', request.args.get('after_id', type=int))
+
+    offset = 0
+    if after_id is None:
+        if 'offset' in position:
+            offset = position['offset']
+        else:
+            page = max(request.args.get('page', 1, type=int), 1)
+            offset = (page - 1) * per_page
+
+    current_questions, last_id = snapshot.select(fields, per_page, after_id, offset, category_id, ids)
+    next_cursor = encode_cursor(last_id, scope) if last_id is not None else None
+    return current_questions, total_questions, next_cursor
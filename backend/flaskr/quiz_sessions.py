@@ -0,0 +1,119 @@
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# Feistel rounds of the permutation of question ids
+PERMUTATION_ROUNDS = 4
+# Sessions share this many locks, picked by session id
+SESSION_LOCKS = 64
+
+
+class InMemorySessionStore:
+    """
+    Bounded session store with TTL and LRU eviction.
+
+    Any object exposing the same get/set/delete methods can be passed as
+    QUIZ_SESSION_STORE to keep sessions in an external backend instead.
+    """
+
+    def __init__(self, max_sessions, ttl):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return None
+            expires_at, session = entry
+            if expires_at < time.monotonic():
+                del self.sessions[session_id]
+                return None
+            self.sessions.move_to_end(session_id)
+            return session
+
+    def set(self, session_id, session):
+        with self.lock:
+            self.sessions[session_id] = (time.monotonic() + self.ttl, session)
+            self.sessions.move_to_end(session_id)
+            # Evict least recently used sessions beyond the bound
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+"""
+permute(index, size, seed)
+    returns the image of index by a pseudo-random permutation of
+    range(size) keyed by seed: a Feistel network over the smallest even
+    number of bits covering size, walking the cycle until the image falls
+    in range
+"""
+def permute(index, size, seed):
+    half_bits = (max(size - 1, 1).bit_length() + 1) // 2
+    mask = (1 << half_bits) - 1
+    while True:
+        left, right = index >> half_bits, index & mask
+        for round_number in range(PERMUTATION_ROUNDS):
+            digest = hashlib.blake2b(f'{seed}:{round_number}:{right}'.encode(), digest_size=8).digest()
+            left, right = right, left ^ (int.from_bytes(digest, 'big') & mask)
+        index = (left << half_bits) | right
+        if index < size:
+            return index
+
+
+class QuizSessions:
+    """
+    Quiz sessions serving the questions of a category in a random order
+    without repeating them, so clients do not have to resend the
+    questions they already played.
+
+    A session stores the ids of its category in a compact array (8 bytes
+    per question), a seed and a position: the n-th question is the id at
+    the n-th index of a permutation of the array computed on demand, so
+    serving a question is O(1) and creating a session does not shuffle.
+    next_id() updates a session under one of SESSION_LOCKS locks picked
+    by its id, which makes concurrent calls of one process serve distinct
+    questions without blocking the other sessions.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.locks = [threading.Lock() for _ in range(SESSION_LOCKS)]
+
+    def create(self, question_ids):
+        """Start a session over the `question_ids` array and return its id and size."""
+        session_id = secrets.token_urlsafe(16)
+        self.store.set(session_id, {
+            'ids': question_ids,
+            'seed': secrets.randbits(64),
+            'position': 0,
+        })
+        return session_id, len(question_ids)
+
+    def next_id(self, session_id):
+        """
+        Return the next question id of the session (None once every
+        question was served) and the number of questions left after it.
+        Raise KeyError for an unknown or expired session.
+        """
+        with self.locks[hash(session_id) % SESSION_LOCKS]:
+            session = self.store.get(session_id)
+            if session is None:
+                raise KeyError(session_id)
+            position, size = session['position'], len(session['ids'])
+            if position >= size:
+                return None, 0
+            session['position'] = position + 1
+            self.store.set(session_id, session)
+        return session['ids'][permute(position, size, session['seed'])], size - position - 1
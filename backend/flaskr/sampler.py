@@ -0,0 +1,284 @@
+import itertools
+import random
+import sys
+import threading
+import time
+from array import array
+from collections import Counter
+
+from sqlalchemy import func
+
+from models.models import Question
+
+ALL_CATEGORIES = 0
+MAX_REJECTIONS = 8
+
+
+class QuestionSampler:
+    """
+    Picks random question ids for quizzes in O(1).
+
+    Keeps an array of question ids per category (plus one for all
+    categories), per `(category, difficulty)` pair, and the position of
+    every id in its arrays, so ids can be added and removed by swapping
+    with the last element. Draws restricted to some difficulties first
+    pick a difficulty with cumulative weights, then an id of its array.
+    While the arrays are not loaded (cold), sampling falls back to a
+    single-row SQL query. The arrays are read and changed under a lock,
+    as request threads and the change feed write them concurrently.
+
+    The listener only sees the writes of this process, and of the others
+    through the change feed. Without it, the arrays are reloaded every
+    `reconcile_interval` seconds to pick up the questions written by the
+    other workers. A reload is built aside, then swapped in with the
+    writes applied while it was read.
+    """
+
+    def __init__(self, reconcile_interval=None):
+        self.buckets = None
+        self.positions = None
+        self.reconcile_interval = reconcile_interval
+        self.warmed_at = 0
+        # Writes applied during a reload, None while there is no reload
+        self.pending = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_warm(self):
+        return self.buckets is not None
+
+    def warm(self, rows=None):
+        """
+        Load the id of every question, grouped by category and difficulty.
+        `rows` are questions already read in QUESTION_FIELDS order.
+        """
+        with self.lock:
+            self.pending = []
+        self._reload(rows)
+
+    def reconcile(self):
+        """Reload the arrays once they are older than `reconcile_interval` seconds."""
+        with self.lock:
+            if self.reconcile_interval is None or not self.is_warm or self.pending is not None or \
+                    time.monotonic() - self.warmed_at <= self.reconcile_interval:
+                return
+            # Other threads keep drawing from the current arrays meanwhile
+            self.pending = []
+        try:
+            self._reload()
+        except:
+            print(sys.exc_info())
+
+    def _reload(self, rows=None):
+        try:
+            if rows is None:
+                rows = Question.query.with_entities(Question.id, Question.category, Question.difficulty).all()
+            else:
+                rows = [(question_id, category, difficulty) for question_id, _, _, category, difficulty in rows]
+            loaded = QuestionSampler()
+            loaded.buckets, loaded.positions = {ALL_CATEGORIES: []}, {}
+            for question_id, category, difficulty in rows:
+                loaded._add(question_id, category, difficulty)
+        except:
+            with self.lock:
+                self.pending = None
+            raise
+        with self.lock:
+            for action, question in self.pending:
+                loaded._apply(action, question)
+            self.buckets, self.positions = loaded.buckets, loaded.positions
+            self.warmed_at = time.monotonic()
+            self.pending = None
+
+    def _add(self, question_id, category, difficulty):
+        if question_id in self.positions:
+            self._remove(question_id)
+        positions = {}
+        keys = [ALL_CATEGORIES]
+        if difficulty is not None:
+            keys.append((ALL_CATEGORIES, int(difficulty)))
+        # Questions without a category are only drawn for all categories
+        if category is not None:
+            keys.append(int(category))
+            if difficulty is not None:
+                keys.append((int(category), int(difficulty)))
+        for key in keys:
+            bucket = self.buckets.setdefault(key, [])
+            positions[key] = len(bucket)
+            bucket.append(question_id)
+        self.positions[question_id] = positions
+
+    def _remove(self, question_id):
+        positions = self.positions.pop(question_id, {})
+        for key, index in positions.items():
+            # Move the last id into the freed slot so that removal stays O(1)
+            bucket = self.buckets[key]
+            last_id = bucket.pop()
+            if index < len(bucket):
+                bucket[index] = last_id
+                self.positions[last_id][key] = index
+
+    def _apply(self, action, question):
+        if action == 'delete':
+            self._remove(question['id'])
+        else:
+            self._add(question['id'], question['category'], question['difficulty'])
+
+    def on_question_change(self, action, question):
+        """Question listener keeping the arrays in sync with the database."""
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((action, question))
+            if self.is_warm:
+                self._apply(action, question)
+
+    def discard(self, question_id):
+        """Forget an id drawn for a question deleted by another process."""
+        self.on_question_change('delete', {'id': question_id})
+
+    def _weighted_buckets(self, category_id, difficulties, weights):
+        """
+        Return the non-empty `(ids, weight)` arrays to draw from. Without
+        weights, difficulties are weighted by their number of questions so
+        that every question is equally likely.
+        """
+        if weights is None and difficulties is None:
+            pairs = [(self.buckets.get(category_id, []), 1)]
+        elif weights is None:
+            pairs = [
+                (bucket, len(bucket))
+                for bucket in (self.buckets.get((category_id, difficulty), []) for difficulty in difficulties)
+            ]
+        else:
+            pairs = [
+                (self.buckets.get((category_id, difficulty), []), weight)
+                for difficulty, weight in weights.items()
+                if weight > 0 and (difficulties is None or difficulty in difficulties)
+            ]
+        return [(bucket, weight) for bucket, weight in pairs if bucket]
+
+    def sample(self, category_id, previous_questions, difficulties=None, weights=None):
+        """
+        Return a random question id of `category_id` (0 for all categories)
+        that is not in `previous_questions`, or None if there is none left.
+        `difficulties` restricts the draw to some difficulties, and
+        `weights` (`{difficulty: weight}`) sets the share of each one.
+        """
+        self.reconcile()
+        with self.lock:
+            if self.is_warm:
+                return self._sample(category_id, previous_questions, difficulties, weights)
+        return self._sample_sql(category_id, previous_questions, difficulties, weights)
+
+    def _sample(self, category_id, previous_questions, difficulties, weights):
+        buckets = self._weighted_buckets(category_id, difficulties, weights)
+        if not buckets:
+            return None
+        cum_weights = list(itertools.accumulate(weight for _, weight in buckets))
+        excluded = set(previous_questions)
+        # Rejection sampling is O(1) while most ids are still available
+        for _ in range(MAX_REJECTIONS):
+            bucket, _ = random.choices(buckets, cum_weights=cum_weights)[0]
+            question_id = random.choice(bucket)
+            if question_id not in excluded:
+                return question_id
+        # Most ids were already asked, pick among the remaining ones
+        remaining = []
+        for bucket, weight in buckets:
+            ids = [question_id for question_id in bucket if question_id not in excluded]
+            if ids:
+                remaining.append((ids, weight if weights is not None else len(ids)))
+        if not remaining:
+            return None
+        ids, _ = random.choices(remaining, weights=[weight for _, weight in remaining])[0]
+        return random.choice(ids)
+
+    def sample_many(self, category_id, previous_questions, count, difficulties=None, weights=None):
+        """
+        Return up to `count` distinct random question ids, drawn like
+        sample(). Cold samplers draw them with a single query per difficulty.
+        """
+        self.reconcile()
+        with self.lock:
+            if self.is_warm:
+                excluded = set(previous_questions)
+                question_ids = []
+                for _ in range(count):
+                    question_id = self._sample(category_id, excluded, difficulties, weights)
+                    if question_id is None:
+                        break
+                    question_ids.append(question_id)
+                    excluded.add(question_id)
+                return question_ids
+        return self._sample_many_sql(category_id, previous_questions, count, difficulties, weights)
+
+    def question_ids(self, category_id):
+        """Return the ids of every question of `category_id` (0 for all) as a compact array."""
+        self.reconcile()
+        with self.lock:
+            if self.is_warm:
+                return array('q', self.buckets.get(category_id, []))
+        query = Question.query.with_entities(Question.id)
+        if category_id != ALL_CATEGORIES:
+            query = query.filter(Question.category == category_id)
+        return array('q', (row[0] for row in query.all()))
+
+    def _sample_sql(self, category_id, previous_questions, difficulties=None, weights=None):
+        """Pick a row with OFFSET floor(random() * count) LIMIT 1."""
+        if weights is not None:
+            # Draw a difficulty by weight, then a question of that difficulty
+            candidates = {
+                difficulty: weight for difficulty, weight in weights.items()
+                if weight > 0 and (difficulties is None or difficulty in difficulties)
+            }
+            while candidates:
+                difficulty = random.choices(list(candidates), weights=list(candidates.values()))[0]
+                question_id = self._sample_sql(category_id, previous_questions, [difficulty])
+                if question_id is not None:
+                    return question_id
+                del candidates[difficulty]
+            return None
+
+        query = self._candidates(category_id, previous_questions, difficulties)
+        count = query.count()
+        if count == 0:
+            return None
+        row = query.with_entities(Question.id)\
+            .order_by(Question.id)\
+            .offset(random.randrange(count))\
+            .limit(1)\
+            .first()
+        return row[0] if row else None
+
+    def _sample_many_sql(self, category_id, previous_questions, count, difficulties=None, weights=None):
+        """Pick rows with ORDER BY random() LIMIT count."""
+        if weights is not None:
+            # Split the draws between difficulties by weight
+            candidates = {
+                difficulty: weight for difficulty, weight in weights.items()
+                if weight > 0 and (difficulties is None or difficulty in difficulties)
+            }
+            if not candidates:
+                return []
+            levels = random.choices(list(candidates), weights=list(candidates.values()), k=count)
+            question_ids = []
+            for difficulty, level_count in Counter(levels).items():
+                question_ids += self._sample_many_sql(category_id, previous_questions, level_count, [difficulty])
+            random.shuffle(question_ids)
+            return question_ids
+
+        rows = self._candidates(category_id, previous_questions, difficulties)\
+            .with_entities(Question.id)\
+            .order_by(func.random())\
+            .limit(count)\
+            .all()
+        return [row[0] for row in rows]
+
+    def _candidates(self, category_id, previous_questions, difficulties=None):
+        """Query of the questions a draw can pick."""
+        query = Question.query.filter(Question.id.notin_(previous_questions))
+        if category_id != ALL_CATEGORIES:
+            query = query.filter(Question.category == category_id)
+        if difficulties is not None:
+            query = query.filter(Question.difficulty.in_(list(difficulties)))
+        return query
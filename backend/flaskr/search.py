@@ -0,0 +1,167 @@
+import bisect
+import re
+import threading
+
+from sqlalchemy import func
+
+from models.models import db, Question
+
+SEARCH_CONFIG = 'simple'
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+"""
+tokenize(text)
+    splits text into lowercase words, like the 'simple' Postgres parser
+"""
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+"""
+question_document(include_answers)
+    SQL expression of the text searched in each question, the Postgres
+    GIN indexes of models.migrations are built on the same expressions
+"""
+def question_document(include_answers):
+    document = func.coalesce(Question.question, '')
+    if include_answers:
+        document = document + ' ' + func.coalesce(Question.answer, '')
+    return document
+
+
+class InvertedIndex:
+    """
+    In-process inverted index from words to question ids, used when the
+    database has no full-text search (SQLite in tests and benchmarks).
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.vocabulary = []
+        self.documents = {}
+
+    def add(self, question_id, text):
+        self.remove(question_id)
+        tokens = set(tokenize(text))
+        self.documents[question_id] = tokens
+        for token in tokens:
+            if token not in self.postings:
+                self.postings[token] = set()
+                bisect.insort(self.vocabulary, token)
+            self.postings[token].add(question_id)
+
+    def remove(self, question_id):
+        for token in self.documents.pop(question_id, ()):
+            postings = self.postings[token]
+            postings.discard(question_id)
+            if not postings:
+                del self.postings[token]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+
+    def prefixed(self, prefix):
+        """Return the ids of questions having a word starting with prefix."""
+        ids = set()
+        vocabulary = self.vocabulary
+        # By index, so only the matching tokens are visited
+        for index in range(bisect.bisect_left(vocabulary, prefix), len(vocabulary)):
+            token = vocabulary[index]
+            if not token.startswith(prefix):
+                break
+            ids |= self.postings[token]
+        return ids
+
+    def search(self, tokens):
+        """
+        Return the ids of questions containing every token, the last one
+        being matched as a prefix so that partial words typed so far match.
+        """
+        ids = self.prefixed(tokens[-1])
+        for token in tokens[:-1]:
+            ids &= self.postings.get(token, set())
+        return ids
+
+
+class QuestionSearch:
+    """
+    Full-text search over questions (and optionally answers).
+
+    On Postgres, searches use GIN-indexed `to_tsvector` expressions and are
+    ranked with `ts_rank`. Other databases use an InvertedIndex kept in sync
+    by the question listener. Both match every word of the search term,
+    the last one as a prefix.
+    """
+
+    def __init__(self):
+        self.indexes = None
+        self.lock = threading.Lock()
+
+    @property
+    def uses_postgres(self):
+        return db.engine.dialect.name == 'postgresql'
+
+    def setup(self, in_process=False, rows=None):
+        """
+        Build the in-process indexes when not on Postgres, or when
+        `in_process` searches are served without the database.
+        """
+        if in_process or not self.uses_postgres:
+            self.warm(rows)
+
+    def warm(self, rows=None):
+        """Build the indexes, from `rows` in QUESTION_FIELDS order when given."""
+        if rows is None:
+            rows = Question.query.with_entities(Question.id, Question.question, Question.answer).all()
+        else:
+            rows = [(question_id, question, answer) for question_id, question, answer, _, _ in rows]
+        indexes = {False: InvertedIndex(), True: InvertedIndex()}
+        for question_id, question, answer in rows:
+            indexes[False].add(question_id, question)
+            indexes[True].add(question_id, f'{question} {answer}')
+        with self.lock:
+            self.indexes = indexes
+
+    def on_question_change(self, action, question):
+        """Question listener keeping the in-process indexes in sync."""
+        with self.lock:
+            if self.indexes is None:
+                return
+            if action == 'delete':
+                self.indexes[False].remove(question['id'])
+                self.indexes[True].remove(question['id'])
+            else:
+                self.indexes[False].add(question['id'], question['question'])
+                self.indexes[True].add(question['id'], f"{question['question']} {question['answer']}")
+
+    def filter(self, query, search_term, include_answers=False):
+        """
+        Restrict a question query to the questions matching search_term.
+        Return the query, a ranking expression (None when results are
+        ordered by id) and the number of matches when it is already known.
+        """
+        tokens = tokenize(search_term)
+        # A blank search term matches every question
+        if not tokens:
+            return query, None, None
+
+        if self.uses_postgres:
+            vector = func.to_tsvector(SEARCH_CONFIG, question_document(include_answers))
+            ts_query = func.to_tsquery(SEARCH_CONFIG, ' & '.join(tokens[:-1] + [tokens[-1] + ':*']))
+            return query.filter(vector.op('@@')(ts_query)), func.ts_rank(vector, ts_query), None
+
+        ids = self.match_ids(search_term, include_answers)
+        return query.filter(Question.id.in_(ids)), None, len(ids)
+
+    def match_ids(self, search_term, include_answers=False):
+        """
+        Return the set of ids of the questions matching search_term with
+        the in-process indexes, whatever the database, or None when every
+        question matches.
+        """
+        tokens = tokenize(search_term)
+        if not tokens:
+            return None
+        if self.indexes is None:
+            self.warm()
+        with self.lock:
+            return self.indexes[include_answers].search(tokens)
@@ -0,0 +1,64 @@
+import json
+
+from flask import current_app
+
+# orjson is optional, the stdlib encoder is used when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibSerializer:
+    """Compact JSON encoding with the standard library."""
+
+    name = 'json'
+
+    def dumps(self, payload):
+        return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        # json only parses bytes and str, buffers are copied first
+        return json.loads(bytes(data))
+
+
+class OrjsonSerializer:
+    """JSON encoding with orjson, several times faster on large pages."""
+
+    name = 'orjson'
+
+    def dumps(self, payload):
+        # Category maps are keyed by integer ids
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data):
+        # Parses memoryviews in place, e.g. of a memory-mapped file
+        return orjson.loads(data)
+
+
+SERIALIZERS = {StdlibSerializer.name: StdlibSerializer}
+if orjson is not None:
+    SERIALIZERS[OrjsonSerializer.name] = OrjsonSerializer
+
+
+"""
+get_serializer(name)
+    returns the serializer registered under `name`, or the fastest
+    installed one when name is None. Raises ValueError for unknown names
+"""
+def get_serializer(name=None):
+    if name is None:
+        name = OrjsonSerializer.name if orjson is not None else StdlibSerializer.name
+    if name not in SERIALIZERS:
+        raise ValueError(f'Unknown JSON serializer {name!r}.')
+    return SERIALIZERS[name]()
+
+
+"""
+json_response(payload, status)
+    encodes payload with the serializer of the current app, the
+    replacement of jsonify() on the API routes
+"""
+def json_response(payload, status=200):
+    body = current_app.extensions['json_serializer'].dumps(payload)
+    return current_app.response_class(body, status=status, mimetype='application/json')
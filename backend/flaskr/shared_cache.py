@@ -0,0 +1,217 @@
+"""
+Shared payloads
+
+A warm-up cache shared by the worker processes of a host through a
+memory-mapped file, preferably on a tmpfs such as /dev/shm. A preload
+hook, or the first worker to start, reads the categories and questions
+once and publishes them as JSON; every other worker decodes them to warm
+its in-process caches instead of querying the database.
+
+The payloads are only read while warming up, and after a write made them
+stale: requests are never served from the mapping. They save the queries
+and their encoding, not memory nor decoding, each worker still decodes
+the rows and builds its own structures from them.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from models.models import Question
+from .cache import CATEGORIES_PAYLOAD, query_categories, categories_body
+
+MAGIC = b'TRVP'
+# Bumped whenever the file layout changes, files of another layout are ignored
+LAYOUT_VERSION = 1
+# Magic, layout version, generation of the payloads and number of payloads
+HEADER = struct.Struct('<4sIQI')
+# Name, offset and length of each payload
+ENTRY = struct.Struct('<32sQQ')
+GENERATION = struct.Struct('<Q')
+# Every question as rows in QUESTION_FIELDS order
+QUESTIONS_PAYLOAD = 'questions'
+
+
+class SharedPayloads:
+    """
+    Named payloads in a file mapped read-only by every worker.
+
+    The file is never modified: publish() writes a new one next to it and
+    renames it over the old one, so readers never see a partial file. Its
+    header records the layout version and the generation the payloads
+    were built for. The current generation is a counter in a separate
+    `<path>.generation` file, incremented by the question and category
+    listeners of every worker: payloads of an older generation are stale, get() then
+    returns None until they are published again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mapping = None
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.lock = threading.Lock()
+
+        self.generation_fd = os.open(f'{path}.generation', os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.generation_fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.generation_fd).st_size < GENERATION.size:
+                os.ftruncate(self.generation_fd, GENERATION.size)
+        finally:
+            fcntl.flock(self.generation_fd, fcntl.LOCK_UN)
+        self.generation_map = mmap.mmap(self.generation_fd, GENERATION.size)
+
+    def generation(self):
+        return GENERATION.unpack_from(self.generation_map)[0]
+
+    def bump(self):
+        """Make the published payloads stale in every worker."""
+        # flock() excludes other processes, the lock other threads
+        with self.lock:
+            fcntl.flock(self.generation_fd, fcntl.LOCK_EX)
+            try:
+                GENERATION.pack_into(self.generation_map, 0, self.generation() + 1)
+            finally:
+                fcntl.flock(self.generation_fd, fcntl.LOCK_UN)
+
+    def on_change(self, action, row):
+        """Question and category listener invalidating the payloads after each write."""
+        self.bump()
+
+    def publish(self, payloads, generation):
+        """Replace the file with `{name: bytes}` payloads built for generation."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temporary_path = tempfile.mkstemp(dir=directory, prefix='.payloads-')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(HEADER.pack(MAGIC, LAYOUT_VERSION, generation, len(payloads)))
+                offset = HEADER.size + ENTRY.size * len(payloads)
+                for name, payload in payloads.items():
+                    file.write(ENTRY.pack(name.encode('utf-8'), offset, len(payload)))
+                    offset += len(payload)
+                for payload in payloads.values():
+                    file.write(payload)
+            os.replace(temporary_path, self.path)
+        except:
+            os.unlink(temporary_path)
+            raise
+
+    def build(self, build_payloads):
+        """
+        Publish build_payloads() for the current generation. Workers
+        building at the same time wait for the first one, then find its
+        payloads fresh. Return whether this call published them.
+        """
+        fd = os.open(f'{self.path}.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # Writes committed while building bump the generation, so the
+            # payloads are stale rather than silently missing them
+            generation = self.generation()
+            with self.lock:
+                mapping = self._remap()
+            if mapping is not None and mapping[1] == generation:
+                return False
+            self.publish(build_payloads(), generation)
+            with self.lock:
+                self.builds += 1
+            return True
+        finally:
+            os.close(fd)
+
+    def _remap(self):
+        """Map the file currently at path, None when missing or of another layout."""
+        try:
+            file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        with file:
+            stat = os.fstat(file.fileno())
+            if self.mapping is not None and self.mapping[0] == stat.st_ino:
+                return self.mapping
+            if stat.st_size < HEADER.size:
+                return None
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, layout_version, generation, count = HEADER.unpack_from(data)
+        if magic != MAGIC or layout_version != LAYOUT_VERSION:
+            return None
+        # Payloads are views of the mapping, nothing is copied. The previous
+        # mapping is unmapped once the last of its views is released
+        view = memoryview(data)
+        payloads = {}
+        for index in range(count):
+            name, offset, length = ENTRY.unpack_from(data, HEADER.size + index * ENTRY.size)
+            payloads[name.rstrip(b'\0').decode('utf-8')] = view[offset:offset + length]
+        self.mapping = (stat.st_ino, generation, payloads)
+        return self.mapping
+
+    def get(self, name):
+        """Return a read-only memoryview of a fresh payload, None otherwise."""
+        generation = self.generation()
+        with self.lock:
+            mapping = self.mapping
+            if mapping is None or mapping[1] != generation:
+                mapping = self._remap()
+            if mapping is None or mapping[1] != generation or name not in mapping[2]:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return mapping[2][name]
+
+    def stats(self):
+        mapping = self.mapping
+        return {
+            'generation': self.generation(),
+            'built_generation': mapping[1] if mapping else None,
+            'payloads': {name: len(payload) for name, payload in mapping[2].items()} if mapping else {},
+            'hits': self.hits,
+            'misses': self.misses,
+            'builds': self.builds,
+        }
+
+
+"""
+build_payloads(serializer)
+    reads the payloads shared by the workers: the body of GET /categories
+    and every question as rows in QUESTION_FIELDS order
+"""
+def build_payloads(serializer):
+    rows = Question.query.with_entities(*Question.columns()).order_by(Question.id).all()
+    return {
+        CATEGORIES_PAYLOAD: categories_body(serializer, query_categories()),
+        QUESTIONS_PAYLOAD: serializer.dumps([list(row) for row in rows]),
+    }
+
+
+"""
+publish_payloads(app)
+    builds and publishes the shared payloads of the app, e.g. from a
+    gunicorn when_ready hook before the workers start
+"""
+def publish_payloads(app):
+    shared = app.extensions.get('shared_payloads')
+    if shared is None:
+        return False
+    with app.app_context():
+        return shared.build(lambda: build_payloads(app.extensions['json_serializer']))
+
+
+"""
+question_rows(shared, serializer)
+    returns every question as rows in QUESTION_FIELDS order to warm up
+    from, decoded from the shared payloads when they are fresh, publishing them first, or waiting
+    for the worker publishing them, when they are not. Falls back to the
+    database when a write made them stale again meanwhile
+"""
+def question_rows(shared, serializer):
+    if shared is not None:
+        payload = shared.get(QUESTIONS_PAYLOAD)
+        if payload is None:
+            shared.build(lambda: build_payloads(serializer))
+            payload = shared.get(QUESTIONS_PAYLOAD)
+        if payload is not None:
+            return serializer.loads(payload)
+    return Question.query.with_entities(*Question.columns()).all()
@@ -0,0 +1,196 @@
+"""
+Question snapshot
+
+Opt-in (QUESTION_SNAPSHOT) copy of the whole question bank, loaded once
+per process and served by GET /questions, GET /categories/<id>/questions,
+POST /questions/search and POST /quizzes without any query. The question
+listener applies the writes of this process, and those of the other
+processes through the change feed, which QUESTION_SNAPSHOT turns on.
+"""
+import bisect
+import itertools
+import operator
+import sys
+import threading
+from array import array
+from collections import Counter
+
+from models.models import Question, QUESTION_FIELDS
+
+# Stored in the integer columns in place of NULL
+MISSING = -1
+INTEGER_FIELDS = ('id', 'category', 'difficulty')
+TEXT_FIELDS = tuple(field for field in QUESTION_FIELDS if field not in INTEGER_FIELDS)
+
+
+"""
+empty_columns()
+    returns one empty column per question field: machine integer arrays
+    for the integer fields, lists of strings for the texts
+"""
+def empty_columns():
+    return {
+        field: array('q') if field in INTEGER_FIELDS else []
+        for field in QUESTION_FIELDS
+    }
+
+
+"""
+column_value(field, value)
+    converts a question value to what its column stores, i.e. MISSING
+    for NULL integers and interned strings, so that repeated answers
+    share one object
+"""
+def column_value(field, value):
+    if field in INTEGER_FIELDS:
+        return MISSING if value is None else int(value)
+    return sys.intern(value) if value is not None else None
+
+
+class QuestionSnapshot:
+    """
+    Column-oriented copy of every question.
+
+    Rows are kept sorted by id in parallel columns, one per question
+    field, so a row costs a few machine words and two string references
+    instead of an ORM instance and its dicts. Pages are selected by
+    bisecting the id column and formatted only for the rows returned.
+    The number of cells referencing each distinct string, and their
+    total size, are kept up to date by every write, so stats() is O(1).
+    """
+
+    def __init__(self):
+        self.columns = empty_columns()
+        self.strings = Counter()
+        self.string_bytes = 0
+        self.is_loaded = False
+        self.lock = threading.Lock()
+
+    def load(self, rows=None):
+        """
+        Replace the snapshot with every question of the database, or
+        with `rows` already read in QUESTION_FIELDS order.
+        """
+        if rows is None:
+            rows = Question.query.with_entities(*Question.columns()).order_by(Question.id).all()
+        else:
+            rows = sorted(rows, key=lambda row: row[0])
+        columns = empty_columns()
+        for row in rows:
+            for field, value in zip(QUESTION_FIELDS, row):
+                columns[field].append(column_value(field, value))
+        strings = Counter(text for field in TEXT_FIELDS for text in columns[field] if text is not None)
+        string_bytes = sum(sys.getsizeof(text) for text in strings)
+        with self.lock:
+            self.columns = columns
+            self.strings = strings
+            self.string_bytes = string_bytes
+            self.is_loaded = True
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def _position(self, question_id):
+        ids = self.columns['id']
+        position = bisect.bisect_left(ids, question_id)
+        if position < len(ids) and ids[position] == question_id:
+            return position
+        return None
+
+    def _format(self, position, fields=QUESTION_FIELDS):
+        row = {}
+        for field in fields:
+            value = self.columns[field][position]
+            row[field] = None if field in INTEGER_FIELDS and value == MISSING else value
+        return row
+
+    def _category_positions(self, category_id, start):
+        # Compared in C by the iterators, without copying the column
+        matches = map(operator.eq, itertools.islice(self.columns['category'], start, None),
+                      itertools.repeat(category_id))
+        return itertools.compress(itertools.count(start), matches)
+
+    def _count_strings(self, position, delta):
+        """Add `delta` references to the strings of the row at position."""
+        for field in TEXT_FIELDS:
+            text = self.columns[field][position]
+            if text is None:
+                continue
+            self.strings[text] += delta
+            if self.strings[text] == 0:
+                del self.strings[text]
+                self.string_bytes -= sys.getsizeof(text)
+            elif self.strings[text] == delta:
+                self.string_bytes += sys.getsizeof(text)
+
+    def on_question_change(self, action, question):
+        """Question listener applying each committed write to the columns."""
+        with self.lock:
+            if not self.is_loaded:
+                return
+            position = self._position(question['id'])
+            if position is not None:
+                self._count_strings(position, -1)
+            if action == 'delete':
+                if position is not None:
+                    for column in self.columns.values():
+                        del column[position]
+                return
+            values = {field: column_value(field, question[field]) for field in QUESTION_FIELDS}
+            if position is not None:
+                for field, column in self.columns.items():
+                    column[position] = values[field]
+            else:
+                # New ids are the largest ones, so this is an append in practice
+                position = bisect.bisect_left(self.columns['id'], values['id'])
+                for field, column in self.columns.items():
+                    column.insert(position, values[field])
+            self._count_strings(position, 1)
+
+    def get(self, question_id):
+        """Return the formatted question, None if there is no such id."""
+        with self.lock:
+            position = self._position(question_id)
+            return self._format(position) if position is not None else None
+
+    def count(self, category_id=None):
+        with self.lock:
+            if category_id is None:
+                return len(self)
+            return self.columns['category'].count(category_id)
+
+    def select(self, fields, limit, after_id=None, offset=0, category_id=None, ids=None):
+        """
+        Return up to `limit` questions ordered by id, with only `fields`,
+        starting after `after_id` and skipping `offset` matches. Rows are
+        restricted to `category_id`, or to the set of `ids`. The id of the
+        last question returned comes second, None on the last page.
+        """
+        with self.lock:
+            question_ids = self.columns['id']
+            start = bisect.bisect_right(question_ids, after_id) if after_id is not None else 0
+            if ids is not None:
+                positions = sorted(
+                    position for position in map(self._position, ids)
+                    if position is not None and position >= start)
+            elif category_id is not None:
+                positions = self._category_positions(category_id, start)
+            else:
+                positions = range(start, len(question_ids))
+            # One extra row tells whether there is a next page
+            selected = list(itertools.islice(positions, offset, offset + limit + 1))
+            has_next = len(selected) > limit
+            selected = selected[:limit]
+            questions = [self._format(position, fields) for position in selected]
+            return questions, question_ids[selected[-1]] if has_next else None
+
+    def stats(self):
+        """Number of rows and approximate memory footprint, in bytes."""
+        with self.lock:
+            column_bytes = sum(sys.getsizeof(column) for column in self.columns.values())
+            return {
+                'loaded': self.is_loaded,
+                'questions': len(self),
+                'distinct_strings': len(self.strings),
+                'bytes': column_bytes + self.string_bytes,
+            }
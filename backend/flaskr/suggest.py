@@ -0,0 +1,139 @@
+import bisect
+import sys
+import threading
+from collections import Counter
+
+from models.models import Question
+from .search import tokenize
+
+# Memory taken by each (word, question id) pair of the index
+ENTRY_SIZE = sys.getsizeof(('', 0))
+
+
+"""
+footprint(question_id, title, words, word_counts, delta)
+    returns the bytes taken by a question in the index, counting the
+    strings of its words only when they are not shared with another
+    question. Adds delta (1 when added, -1 when removed) to the number
+    of questions of each word in word_counts
+"""
+def footprint(question_id, title, words, word_counts, delta):
+    size = sys.getsizeof(question_id) + sys.getsizeof(title) + sys.getsizeof(words)
+    for word in words:
+        size += ENTRY_SIZE
+        word_counts[word] += delta
+        if word_counts[word] == max(delta, 0):
+            # First question added or last one removed with this word
+            size += sys.getsizeof(word)
+        if not word_counts[word]:
+            del word_counts[word]
+    return size
+
+
+class SuggestIndex:
+    """
+    Prefix index answering search-as-you-type suggestions in memory.
+
+    Keeps a sorted array of `(word, question id)` pairs built from the
+    question texts: the questions having a word starting with a prefix are
+    a contiguous range found with bisect. Questions are added and removed
+    one at a time by the question listener, which also keeps the memory
+    taken by the questions up to date for stats().
+    """
+
+    def __init__(self):
+        self.entries = None
+        self.titles = {}
+        self.words = {}
+        self.word_counts = Counter()
+        self.question_bytes = 0
+        self.lock = threading.Lock()
+
+    @property
+    def is_warm(self):
+        return self.entries is not None
+
+    def warm(self, rows=None):
+        """Build the index, from `rows` in QUESTION_FIELDS order when given."""
+        if rows is None:
+            rows = Question.query.with_entities(Question.id, Question.question).all()
+        else:
+            rows = [(question_id, question) for question_id, question, _, _, _ in rows]
+        entries, titles, words = [], {}, {}
+        word_counts, question_bytes = Counter(), 0
+        for question_id, title in rows:
+            titles[question_id] = title
+            words[question_id] = frozenset(sys.intern(word) for word in tokenize(title))
+            entries.extend((word, question_id) for word in words[question_id])
+            question_bytes += footprint(question_id, title, words[question_id], word_counts, 1)
+        entries.sort()
+        with self.lock:
+            self.entries, self.titles, self.words = entries, titles, words
+            self.word_counts, self.question_bytes = word_counts, question_bytes
+
+    def _add(self, question_id, title):
+        self._remove(question_id)
+        self.titles[question_id] = title
+        self.words[question_id] = frozenset(sys.intern(word) for word in tokenize(title))
+        for word in self.words[question_id]:
+            bisect.insort(self.entries, (word, question_id))
+        self.question_bytes += footprint(question_id, title, self.words[question_id], self.word_counts, 1)
+
+    def _remove(self, question_id):
+        if question_id not in self.titles:
+            return
+        title = self.titles.pop(question_id)
+        words = self.words.pop(question_id)
+        for word in words:
+            index = bisect.bisect_left(self.entries, (word, question_id))
+            del self.entries[index]
+        self.question_bytes -= footprint(question_id, title, words, self.word_counts, -1)
+
+    def on_question_change(self, action, question):
+        """Question listener updating the index after each write."""
+        with self.lock:
+            if not self.is_warm:
+                return
+            if action == 'delete':
+                self._remove(question['id'])
+            else:
+                self._add(question['id'], question['question'])
+
+    def suggest(self, prefix, limit):
+        """
+        Return up to `limit` (id, question) pairs of questions containing
+        every word of `prefix`, the last one possibly incomplete.
+        """
+        tokens = tokenize(prefix)
+        if not tokens:
+            return []
+        if not self.is_warm:
+            self.warm()
+
+        *words, last = tokens
+        suggestions = []
+        seen = set()
+        with self.lock:
+            index = bisect.bisect_left(self.entries, (last,))
+            while index < len(self.entries) and len(suggestions) < limit:
+                word, question_id = self.entries[index]
+                if not word.startswith(last):
+                    break
+                index += 1
+                if question_id in seen or not self.words[question_id].issuperset(words):
+                    continue
+                seen.add(question_id)
+                suggestions.append((question_id, self.titles[question_id]))
+        return suggestions
+
+    def stats(self):
+        """Size of the index, with its memory footprint in bytes."""
+        with self.lock:
+            if not self.is_warm:
+                return {'questions': 0, 'entries': 0, 'bytes': 0}
+            return {
+                'questions': len(self.titles),
+                'entries': len(self.entries),
+                'bytes': (self.question_bytes + sys.getsizeof(self.entries)
+                          + sys.getsizeof(self.titles) + sys.getsizeof(self.words)),
+            }
@@ -0,0 +1,304 @@
+"""
+Schema migrations
+
+db.create_all() only creates missing tables, so databases restored from
+trivia.psql or created by an older version of the models are upgraded
+here. Each migration runs once, in order, and the last applied version is
+recorded in the schema_version table.
+"""
+from sqlalchemy import inspect, text
+
+# Arbitrary key of the Postgres advisory lock serialising concurrent migrations
+MIGRATION_LOCK_KEY = 7324001
+# Arbitrary key of the Postgres advisory lock ordering the versions of changes
+CHANGES_LOCK_KEY = 7324002
+# Channel of the change notifications
+CHANGES_CHANNEL = 'trivia_changes'
+# Postgres rejects notification payloads of 8000 bytes or more
+MAX_NOTIFY_PAYLOAD = 7900
+# Tables whose writes are logged in changes, with their entity name and columns
+LOGGED_TABLES = [
+    ('questions', 'question', ['id', 'question', 'answer', 'category', 'difficulty']),
+    ('categories', 'category', ['id', 'type']),
+]
+
+
+"""
+typed_question_category(connection)
+    stores questions.category as an integer referencing categories.id
+"""
+def typed_question_category(connection):
+    # SQLite columns are not typed, only Postgres needs the conversion
+    if connection.dialect.name != 'postgresql':
+        return
+    data_type = connection.execute(text(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = 'questions' AND column_name = 'category'"
+    )).scalar()
+    if data_type != 'integer':
+        connection.execute(text(
+            "ALTER TABLE questions ALTER COLUMN category TYPE integer USING category::integer"
+        ))
+    foreign_keys = inspect(connection).get_foreign_keys('questions')
+    if not any(foreign_key['constrained_columns'] == ['category'] for foreign_key in foreign_keys):
+        connection.execute(text(
+            "ALTER TABLE questions ADD CONSTRAINT category FOREIGN KEY (category) "
+            "REFERENCES categories (id) ON UPDATE CASCADE ON DELETE SET NULL"
+        ))
+
+
+"""
+question_indexes(connection)
+    indexes the category listings (filtered on category, ordered by id)
+    and difficulty filters
+"""
+def question_indexes(connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_category_id ON questions (category, id)"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_difficulty ON questions (difficulty)"
+    ))
+
+
+"""
+full_text_indexes(connection)
+    GIN indexes matching the expressions of flaskr.search.question_document()
+"""
+def full_text_indexes(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_question_tsv ON questions "
+        "USING GIN (to_tsvector('simple', coalesce(question, '')))"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_document_tsv ON questions "
+        "USING GIN (to_tsvector('simple', coalesce(question, '') || ' ' || coalesce(answer, '')))"
+    ))
+
+
+"""
+change_triggers(connection)
+    logs every write to questions and categories in the changes table.
+    On Postgres, versions are handed out under a transaction lock so that
+    they follow the commit order, and every change is also sent as a
+    notification on CHANGES_CHANNEL (its version only when the row is too
+    large for a payload)
+"""
+def change_triggers(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(f"""
+            CREATE OR REPLACE FUNCTION log_change() RETURNS trigger AS $$
+            DECLARE
+                changed RECORD;
+                change_version BIGINT;
+                payload TEXT;
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    changed := OLD;
+                ELSE
+                    changed := NEW;
+                END IF;
+                PERFORM pg_advisory_xact_lock({CHANGES_LOCK_KEY});
+                INSERT INTO changes (entity, action, entity_id, data)
+                VALUES (TG_ARGV[0], lower(TG_OP), changed.id, row_to_json(changed)::text)
+                RETURNING version INTO change_version;
+                payload := json_build_object(
+                    'version', change_version, 'entity', TG_ARGV[0],
+                    'action', lower(TG_OP), 'data', row_to_json(changed))::text;
+                IF octet_length(payload) > {MAX_NOTIFY_PAYLOAD} THEN
+                    payload := json_build_object('version', change_version)::text;
+                END IF;
+                PERFORM pg_notify('{CHANGES_CHANNEL}', payload);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """))
+        for table, entity, _ in LOGGED_TABLES:
+            connection.execute(text(f"DROP TRIGGER IF EXISTS {table}_changes ON {table}"))
+            connection.execute(text(
+                f"CREATE TRIGGER {table}_changes AFTER INSERT OR UPDATE OR DELETE ON {table} "
+                f"FOR EACH ROW EXECUTE PROCEDURE log_change('{entity}')"
+            ))
+        return
+
+    # SQLite has a single writer, versions follow the commit order already
+    for table, entity, columns in LOGGED_TABLES:
+        for action, row in [('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD')]:
+            data = ', '.join(f"'{column}', {row}.{column}" for column in columns)
+            connection.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_{action}_changes AFTER {action.upper()} ON {table} "
+                f"BEGIN INSERT INTO changes (entity, action, entity_id, data) "
+                f"VALUES ('{entity}', '{action}', {row}.id, json_object({data})); END"
+            ))
+
+
+"""
+changes_backfill(connection)
+    logs the questions written before the changes table existed, so that
+    syncing from version 0 returns every question, and indexes the changes
+    by entity and version
+"""
+def changes_backfill(connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_changes_entity_version ON changes (entity, version)"
+    ))
+    if connection.dialect.name == 'postgresql':
+        data = "row_to_json(questions)::text"
+    else:
+        _, _, columns = LOGGED_TABLES[0]
+        data = 'json_object({})'.format(', '.join(f"'{column}', questions.{column}" for column in columns))
+    connection.execute(text(
+        f"INSERT INTO changes (entity, action, entity_id, data) "
+        f"SELECT 'question', 'insert', questions.id, {data} FROM questions "
+        f"WHERE NOT EXISTS (SELECT 1 FROM changes "
+        f"WHERE changes.entity = 'question' AND changes.entity_id = questions.id) "
+        f"ORDER BY questions.id"
+    ))
+
+
+"""
+deferred_change_triggers(connection)
+    turns the Postgres change triggers into constraint triggers deferred
+    to the commit. The lock ordering the versions is then held from the
+    commit of the writes to its end, instead of from the first write of a
+    transaction: writers still commit one at a time, but their statements,
+    a bulk chunk included, run concurrently
+"""
+def deferred_change_triggers(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    for table, entity, _ in LOGGED_TABLES:
+        connection.execute(text(f"DROP TRIGGER IF EXISTS {table}_changes ON {table}"))
+        connection.execute(text(
+            f"CREATE CONSTRAINT TRIGGER {table}_changes AFTER INSERT OR UPDATE OR DELETE ON {table} "
+            f"DEFERRABLE INITIALLY DEFERRED "
+            f"FOR EACH ROW EXECUTE PROCEDURE log_change('{entity}')"
+        ))
+
+
+"""
+change_retention(connection)
+    records the low-water mark of the changes pruned by
+    flaskr.changes.prune_changes(), and indexes the changes by row to find
+    the superseded ones
+"""
+def change_retention(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS changes_retention (pruned_version BIGINT NOT NULL)"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_changes_entity_row ON changes (entity, entity_id, version)"
+    ))
+
+
+"""
+change_categories(connection)
+    records in each change of a question its category and, for an update,
+    its category before the update, so that every category listing gets
+    the version of the last change that added, removed or edited one of
+    its questions. Logs the categories of the changes already recorded,
+    and the time of each pruning
+"""
+def change_categories(connection):
+    columns = [column['name'] for column in inspect(connection).get_columns('changes')]
+    for column in ('category', 'previous_category'):
+        if column not in columns:
+            connection.execute(text(f"ALTER TABLE changes ADD COLUMN {column} INTEGER"))
+        connection.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_changes_{column} ON changes ({column}, version)"
+        ))
+    connection.execute(text("ALTER TABLE changes_retention ADD COLUMN pruned_at TIMESTAMP WITH TIME ZONE"))
+    connection.execute(text("UPDATE changes_retention SET pruned_at = CURRENT_TIMESTAMP"))
+
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(
+            "UPDATE changes SET category = (data::json->>'category')::integer "
+            "WHERE entity = 'question' AND category IS NULL"
+        ))
+        connection.execute(text(f"""
+            CREATE OR REPLACE FUNCTION log_change() RETURNS trigger AS $$
+            DECLARE
+                changed RECORD;
+                previous_category INTEGER;
+                change_version BIGINT;
+                payload TEXT;
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    changed := OLD;
+                ELSE
+                    changed := NEW;
+                END IF;
+                IF TG_OP = 'UPDATE' THEN
+                    previous_category := (row_to_json(OLD)->>'category')::integer;
+                END IF;
+                PERFORM pg_advisory_xact_lock({CHANGES_LOCK_KEY});
+                INSERT INTO changes (entity, action, entity_id, data, category, previous_category)
+                VALUES (TG_ARGV[0], lower(TG_OP), changed.id, row_to_json(changed)::text,
+                        (row_to_json(changed)->>'category')::integer, previous_category)
+                RETURNING version INTO change_version;
+                payload := json_build_object(
+                    'version', change_version, 'entity', TG_ARGV[0],
+                    'action', lower(TG_OP), 'data', row_to_json(changed))::text;
+                IF octet_length(payload) > {MAX_NOTIFY_PAYLOAD} THEN
+                    payload := json_build_object('version', change_version)::text;
+                END IF;
+                PERFORM pg_notify('{CHANGES_CHANNEL}', payload);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """))
+        return
+
+    connection.execute(text(
+        "UPDATE changes SET category = json_extract(data, '$.category') "
+        "WHERE entity = 'question' AND category IS NULL"
+    ))
+    table, entity, columns = LOGGED_TABLES[0]
+    for action, row in [('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD')]:
+        data = ', '.join(f"'{column}', {row}.{column}" for column in columns)
+        previous_category = 'OLD.category' if action == 'update' else 'NULL'
+        connection.execute(text(f"DROP TRIGGER IF EXISTS {table}_{action}_changes"))
+        connection.execute(text(
+            f"CREATE TRIGGER {table}_{action}_changes AFTER {action.upper()} ON {table} "
+            f"BEGIN INSERT INTO changes (entity, action, entity_id, data, category, previous_category) "
+            f"VALUES ('{entity}', '{action}', {row}.id, json_object({data}), {row}.category, "
+            f"{previous_category}); END"
+        ))
+
+
+MIGRATIONS = [
+    (1, typed_question_category),
+    (2, question_indexes),
+    (3, full_text_indexes),
+    (4, change_triggers),
+    (5, changes_backfill),
+    (6, deferred_change_triggers),
+    (7, change_retention),
+    (8, change_categories),
+]
+
+
+"""
+migrate(engine)
+    applies the migrations newer than the recorded schema version, in a
+    single transaction
+"""
+def migrate(engine):
+    with engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            # Workers starting together must not migrate twice
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), key=MIGRATION_LOCK_KEY)
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"
+        ))
+        current_version = connection.execute(text(
+            "SELECT max(version) FROM schema_version"
+        )).scalar() or 0
+        for version, migration in MIGRATIONS:
+            if version > current_version:
+                migration(connection)
+                connection.execute(text(
+                    "INSERT INTO schema_version (version) VALUES (:version)"
+                ), version=version)
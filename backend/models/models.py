@@ -1,33 +1,98 @@
 import os
+import sys
 import json
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, BigInteger, Text, DateTime, ForeignKey, Index, func, create_engine
+from flask import current_app
 from config import SQLALCHEMY_DATABASE_URI, SQLALCHEMY_TRACK_MODIFICATIONS
+from models.migrations import migrate
+from models.pool import engine_options
+from models.routing import RoutingSQLAlchemy, replica_binds, setup_replicas
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, with the pool
+    settings and read replicas of the app config, creates the missing
+    tables and applies the schema migrations on the primary
 """
 def setup_db(app, database_path=SQLALCHEMY_DATABASE_URI):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = SQLALCHEMY_TRACK_MODIFICATIONS
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config, database_path)
+    app.config["SQLALCHEMY_BINDS"] = replica_binds(app.config["SQLALCHEMY_REPLICA_URIS"])
     db.app = app
     db.init_app(app)
-    db.create_all()
+    db.create_all(bind=None)
+    setup_replicas(app, db)
+    migrate(db.get_engine(app))
+
+"""
+on_question_change(app, listener)
+    registers `listener(action, question)` to be called after a question
+    is committed through Question.insert(), update() or delete().
+    `action` is 'insert', 'update' or 'delete' and `question` is the
+    formatted question as it was committed
+"""
+def on_question_change(app, listener):
+    app.extensions.setdefault('question_listeners', []).append(listener)
+
+"""
+on_category_change(app, listener)
+    registers `listener(action, category)` to be called by the change feed
+    of the app (see flaskr.changes) when a category is written
+"""
+def on_category_change(app, listener):
+    app.extensions.setdefault('category_listeners', []).append(listener)
+
+"""
+notify_question_change(action, question)
+    calls the question listeners registered on the current app
+"""
+def notify_question_change(action, question):
+    notify_question_changes(action, [question])
+
+"""
+notify_question_changes(action, questions)
+    calls the question listeners registered on the current app for each
+    question. When the app follows the change feed, the feed applies
+    these changes instead, in order with those of other processes. The
+    questions are already committed: failures are logged, not raised
+"""
+def notify_question_changes(action, questions):
+    change_feed = current_app.extensions.get('change_feed')
+    if change_feed is not None and change_feed.is_running:
+        try:
+            change_feed.poll()
+        except:
+            # The feed thread applies them once the database is back
+            print(sys.exc_info())
+        return
+    for question in questions:
+        for listener in current_app.extensions.get('question_listeners', []):
+            try:
+                listener(action, question)
+            except:
+                print(sys.exc_info())
 
 """
 Question
 
 """
+QUESTION_FIELDS = ['id', 'question', 'answer', 'category', 'difficulty']
+
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        # Also created on existing databases by models.migrations
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_difficulty', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -38,14 +103,53 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        question = self.format()
         db.session.commit()
+        notify_question_change('insert', question)
 
     def update(self):
+        question = self.format()
         db.session.commit()
+        notify_question_change('update', question)
 
     def delete(self):
+        question = self.format()
         db.session.delete(self)
         db.session.commit()
+        notify_question_change('delete', question)
+
+    @classmethod
+    def insert_many(cls, questions):
+        """
+        Insert a list of question dicts in a single transaction and
+        return their ids. Postgres inserts them with one multi-row
+        INSERT ... RETURNING, other databases row by row.
+        """
+        table = cls.__table__
+        if db.engine.dialect.name == 'postgresql':
+            result = db.session.execute(table.insert().values(questions).returning(table.c.id))
+            ids = [row[0] for row in result]
+        else:
+            ids = [
+                db.session.execute(table.insert(), question).inserted_primary_key[0]
+                for question in questions
+            ]
+        db.session.commit()
+        notify_question_changes('insert', [
+            dict(question, id=question_id) for question_id, question in zip(ids, questions)
+        ])
+        return ids
+
+    @classmethod
+    def columns(cls, fields=QUESTION_FIELDS):
+        """Columns selected to read questions as plain row tuples."""
+        return [getattr(cls, field) for field in fields]
+
+    @staticmethod
+    def format_row(row):
+        """Format a row selected with columns() like format() does."""
+        return dict(zip(QUESTION_FIELDS, row))
 
     def format(self):
         return {
@@ -74,3 +178,31 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
             }
+
+"""
+Change
+
+Every write to questions and categories, logged by the triggers of
+models.migrations. `data` is the row as JSON, as it was before a delete
+and after an insert or update
+"""
+class Change(db.Model):
+    __tablename__ = 'changes'
+    __table_args__ = (
+        # Also created on existing databases by models.migrations
+        Index('ix_changes_entity_version', 'entity', 'version'),
+        Index('ix_changes_entity_row', 'entity', 'entity_id', 'version'),
+        Index('ix_changes_category', 'category', 'version'),
+        Index('ix_changes_previous_category', 'previous_category', 'version'),
+        {'sqlite_autoincrement': True},
+    )
+
+    version = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    entity = Column(String, nullable=False)
+    action = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    data = Column(Text, nullable=False)
+    changed_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    # Category of a question change, and the one it left for an update
+    category = Column(Integer)
+    previous_category = Column(Integer)
@@ -0,0 +1,149 @@
+"""
+Connection pool
+
+Engine options built from the DB_POOL_* settings of config.py, and pool
+classes recording how long checkouts wait for a connection, how many
+connections are in use and how often the pool overflows.
+"""
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, NullPool
+
+# Number of recent checkout latencies kept to compute percentiles
+LATENCY_SAMPLES = 1000
+
+
+class PoolMetrics:
+    """Counters of a connection pool, updated by the Metered pools."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.overflows = 0
+        self.timeouts = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.lock = threading.Lock()
+
+    def checked_out(self, latency, overflow):
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.overflows += overflow
+            self.latencies.append(latency)
+
+    def checked_in(self):
+        with self.lock:
+            self.in_use -= 1
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return {
+                'checkouts': self.checkouts,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'overflows': self.overflows,
+                'timeouts': self.timeouts,
+                'checkout_latency': {
+                    'p50': latencies[len(latencies) // 2] if latencies else 0,
+                    'p95': latencies[int(len(latencies) * 0.95)] if latencies else 0,
+                    'max': latencies[-1] if latencies else 0,
+                },
+            }
+
+
+class MeteredPool:
+    """Mixin timing the checkouts of a SQLAlchemy pool."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+        # State of the checkout running in the current thread
+        self.checkout = threading.local()
+
+    def _do_get(self):
+        if getattr(self.checkout, 'active', False):
+            # QueuePool retries a checkout by calling _do_get again
+            return super()._do_get()
+        self.checkout.active = True
+        self.checkout.overflow = False
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.timed_out()
+            raise
+        finally:
+            self.checkout.active = False
+        self.metrics.checked_out(time.perf_counter() - start, self.checkout.overflow)
+        return connection
+
+    def _do_return_conn(self, connection):
+        self.metrics.checked_in()
+        super()._do_return_conn(connection)
+
+    def stats(self):
+        return dict(self.metrics.stats(), pool=self.status())
+
+
+class MeteredQueuePool(MeteredPool, QueuePool):
+    def _inc_overflow(self):
+        # QueuePool._inc_overflow, also telling the checkout whether the
+        # connection it is about to open is beyond pool_size
+        with self._overflow_lock:
+            if self._max_overflow != -1 and self._overflow >= self._max_overflow:
+                return False
+            self._overflow += 1
+            self.checkout.overflow = self._overflow > 0
+            return True
+
+
+class MeteredNullPool(MeteredPool, NullPool):
+    pass
+
+
+"""
+engine_options(config, database_uri)
+    returns the SQLALCHEMY_ENGINE_OPTIONS matching the DB_POOL_* settings.
+    With DB_PGBOUNCER, connections are opened per checkout and left to
+    PgBouncer to pool. SQLite keeps the pools chosen by Flask-SQLAlchemy
+"""
+def engine_options(config, database_uri):
+    if make_url(database_uri).get_backend_name() == 'sqlite':
+        return {}
+    options = {
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    if config['DB_PGBOUNCER']:
+        # psycopg2 never uses server-side prepared statements, so
+        # transaction pooling only requires not holding connections
+        options['poolclass'] = MeteredNullPool
+    else:
+        options.update({
+            'poolclass': MeteredQueuePool,
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_timeout': config['DB_POOL_TIMEOUT'],
+            'pool_recycle': config['DB_POOL_RECYCLE'],
+        })
+    return options
+
+
+"""
+pool_stats(engine)
+    returns the metrics of the engine pool, None when it is not metered
+"""
+def pool_stats(engine):
+    if not isinstance(engine.pool, MeteredPool):
+        return None
+    return engine.pool.stats()
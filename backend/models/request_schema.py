@@ -1,4 +1,4 @@
-from marshmallow import Schema, fields, ValidationError
+from marshmallow import Schema, fields, validates_schema, ValidationError
 from marshmallow import ValidationError
 
 class CreateQuestionRequestSchema(Schema):
@@ -13,6 +13,7 @@ class CreateQuestionRequestSchema(Schema):
 
 class SearchQuestionRequestSchema(Schema):
     searchTerm = fields.String(required=True)
+    includeAnswers = fields.Boolean()
 
 
 class QuizzesRequestSchema(Schema):
@@ -20,5 +21,30 @@ class QuizzesRequestSchema(Schema):
     class QuizCategorySchema(Schema):
         type = fields.String()
         id = fields.Integer(required=True)
+    # Schema of difficulty, an inclusive range
+    class DifficultyRangeSchema(Schema):
+        min = fields.Integer(required=True, validate=CreateQuestionRequestSchema.validate_difficulty_scale)
+        max = fields.Integer(required=True, validate=CreateQuestionRequestSchema.validate_difficulty_scale)
+        @validates_schema
+        def validate_bounds(self, data, **kwargs):
+            if data['min'] > data['max']:
+                raise ValidationError("Minimum difficulty must not exceed the maximum.")
+    def validate_count(count: int):
+        if count < 1:
+            raise ValidationError("Count must be at least 1.")
+    def validate_weights(weights: dict):
+        if any(weight < 0 for weight in weights.values()) or sum(weights.values()) <= 0:
+            raise ValidationError("Weights must be positive or zero, and not all zero.")
     quiz_category = fields.Nested(QuizCategorySchema)
     previous_questions = fields.List(fields.Int, required=True)
+    difficulty = fields.Nested(DifficultyRangeSchema)
+    count = fields.Integer(validate=validate_count)
+    difficulty_distribution = fields.Dict(
+        keys=fields.Integer(validate=CreateQuestionRequestSchema.validate_difficulty_scale),
+        values=fields.Float(),
+        validate=validate_weights,
+    )
+
+
+class QuizSessionRequestSchema(Schema):
+    quiz_category = fields.Nested(QuizzesRequestSchema.QuizCategorySchema, required=True)
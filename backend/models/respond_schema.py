@@ -15,6 +15,7 @@ class GetQuestionRespondSchema(Schema):
     categories = fields.Dict(keys=fields.Str(), values=fields.Str())
     questions = fields.List(fields.Nested(QuestionsSchema))
     total_questions = fields.Integer()
+    next_cursor = fields.String(allow_none=True)
 
 
 class GetCategoriesRespondSchema(Schema):
@@ -0,0 +1,193 @@
+"""
+Read replica routing
+
+Replicas listed in SQLALCHEMY_REPLICA_URIS are registered as binds. Each
+session reads from one healthy replica, chosen round-robin when it first
+reads, so that all the queries of a request see the same replication lag.
+Everything else goes to the primary: writes, textual SQL other than a
+SELECT, reads of a session that already wrote (read-your-writes) and
+reads of sessions pinned with use_primary().
+"""
+import itertools
+import threading
+import time
+
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, orm, text
+from sqlalchemy.sql.expression import TextAsFrom, TextClause, UpdateBase
+
+REPLICA_BIND_PREFIX = 'replica_'
+
+
+class Replica:
+    """A replica engine and its health."""
+
+    def __init__(self, bind, engine):
+        self.bind = bind
+        self.engine = engine
+        self.healthy = True
+        self.checked_at = 0
+        self.reads = 0
+        self.failures = 0
+
+
+class ReplicaSet:
+    """
+    Round-robin over the replicas of an app.
+
+    A replica is checked with `SELECT 1` at most every `check_interval`
+    seconds, and marked down as soon as one of its connections is lost.
+    Reads fall back to the primary while every replica is down.
+    """
+
+    def __init__(self, replicas, check_interval):
+        self.replicas = replicas
+        self.check_interval = check_interval
+        self.cycle = itertools.cycle(replicas)
+        self.primary_reads = 0
+        self.lock = threading.Lock()
+        for replica in replicas:
+            event.listen(replica.engine, 'handle_error', self.error_handler(replica))
+
+    def error_handler(self, replica):
+        def on_error(context):
+            if context.is_disconnect:
+                self.mark_down(replica)
+        return on_error
+
+    def mark_down(self, replica):
+        with self.lock:
+            replica.healthy = False
+            replica.failures += 1
+            replica.checked_at = time.monotonic()
+
+    def check(self, replica):
+        try:
+            with replica.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except exc.DBAPIError:
+            self.mark_down(replica)
+            return False
+        with self.lock:
+            replica.healthy = True
+            replica.checked_at = time.monotonic()
+        return True
+
+    def available(self, replica):
+        stale = time.monotonic() - replica.checked_at >= self.check_interval
+        return (replica.healthy and not stale) or (stale and self.check(replica))
+
+    def choose(self):
+        """Return the next healthy replica, None if there is none."""
+        for _ in range(len(self.replicas)):
+            with self.lock:
+                replica = next(self.cycle)
+            if self.available(replica):
+                return replica
+        return None
+
+    def count_read(self, replica):
+        """Count a read served by replica, or by the primary if it is None."""
+        with self.lock:
+            if replica is None:
+                self.primary_reads += 1
+            else:
+                replica.reads += 1
+
+    def stats(self):
+        return {
+            'primary_reads': self.primary_reads,
+            'replicas': [
+                {
+                    'bind': replica.bind,
+                    'healthy': replica.healthy,
+                    'reads': replica.reads,
+                    'failures': replica.failures,
+                }
+                for replica in self.replicas
+            ],
+        }
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session routing reads to replicas and everything else to the primary.
+
+    The replica is chosen on the first read and kept until the session is
+    removed at the end of the request, unless it is marked down meanwhile.
+    When every replica is down, the session keeps reading from the
+    primary rather than moving back in time to a replica recovering later.
+    Writes are recognised by the flush, by an INSERT, UPDATE or DELETE
+    statement, or by textual SQL not starting with SELECT.
+    """
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.use_primary = False
+        self.pinned = False
+        self.replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.extensions.get('replicas')
+        writing = self._flushing or isinstance(clause, UpdateBase) or writes_text(clause)
+        if writing:
+            # Later reads of this session must see what it wrote
+            self.use_primary = True
+        if replicas is None or self.use_primary or (mapper is None and clause is None):
+            return super().get_bind(mapper, clause)
+        if not self.pinned or (self.replica is not None and not self.replica.healthy):
+            self.replica = replicas.choose()
+            self.pinned = True
+        replicas.count_read(self.replica)
+        if self.replica is None:
+            return super().get_bind(mapper, clause)
+        return self.replica.engine
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy service whose sessions are RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+"""
+writes_text(clause)
+    returns whether clause is textual SQL that may write, i.e. does not start with SELECT
+"""
+def writes_text(clause):
+    if isinstance(clause, TextAsFrom):
+        clause = clause.element
+    return isinstance(clause, TextClause) and clause.text.lstrip()[:6].upper() != 'SELECT'
+
+
+"""
+replica_binds(replica_uris)
+    returns the SQLALCHEMY_BINDS entries of the replicas
+"""
+def replica_binds(replica_uris):
+    return {f'{REPLICA_BIND_PREFIX}{index}': uri for index, uri in enumerate(replica_uris)}
+
+
+"""
+setup_replicas(app, db)
+    registers the ReplicaSet of the app binds, if there is any replica
+"""
+def setup_replicas(app, db):
+    binds = sorted(bind for bind in app.config['SQLALCHEMY_BINDS'] or {}
+                   if bind.startswith(REPLICA_BIND_PREFIX))
+    if not binds:
+        app.extensions.pop('replicas', None)
+        return
+    app.extensions['replicas'] = ReplicaSet(
+        [Replica(bind, db.get_engine(app, bind=bind)) for bind in binds],
+        check_interval=app.config['REPLICA_CHECK_INTERVAL'],
+    )
+
+
+"""
+use_primary(db)
+    sends every query of the current session (i.e. request) to the primary
+"""
+def use_primary(db):
+    db.session().use_primary = True
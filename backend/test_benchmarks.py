@@ -0,0 +1,238 @@
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+from flask import jsonify
+
+# Shared by every app of the tests, like the workers of a deployment
+os.environ.setdefault('SECRET_KEY', 'trivia-test-secret')
+
+from flaskr import create_app
+from flaskr.pagination import encode_cursor
+from flaskr.serializer import json_response
+from flaskr.snapshot import QuestionSnapshot
+from models.models import db, Question
+from benchmarks.dataset import generate
+from benchmarks.runner import FlaskClientTarget, HttpTarget, serve, run_scenario, compare, rss_bytes
+from benchmarks.scenarios import SCENARIOS
+
+
+class SyntheticQuestionsCase(unittest.TestCase):
+    """Base class of the benchmarks run on a synthetic question bank"""
+
+    categories = 6
+    questions_per_category = 3000
+    repeat = 5
+
+    @property
+    def total_questions(self):
+        return self.categories * self.questions_per_category
+
+    def setUp(self):
+        """Create an SQLite database filled with synthetic questions."""
+        self.db_fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.db_file}',
+            # Measure the endpoints, not the response cache
+            'RESPONSE_CACHE_MAX_BYTES': 0,
+        })
+        self.client = self.app.test_client
+
+        generate(self.app, self.categories, self.questions_per_category)
+
+    def tearDown(self):
+        """Drop the synthetic database."""
+        with self.app.app_context():
+            db.session.remove()
+            db.get_engine(self.app).dispose()
+        os.close(self.db_fd)
+        os.unlink(self.db_file)
+
+    def time_request(self, url):
+        """Return the best wall time of `repeat` GET requests to url."""
+        timings = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            res = self.client().get(url)
+            timings.append(time.perf_counter() - start)
+            self.assertEqual(res.status_code, 200)
+        return min(timings)
+
+    def time_call(self, function):
+        """Return the best wall time of `repeat` calls to function."""
+        timings = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+
+class PaginationBenchmarkCase(SyntheticQuestionsCase):
+    """This class benchmarks question pagination"""
+
+    def test_deep_cursor_page_costs_the_same_as_first_page(self):
+        """
+        Benchmark page 1 against page 1,999 reached through
+        next_cursor and through the page argument
+        """
+
+        per_page = self.app.config['QUESTIONS_PER_PAGE']
+        last_page = self.total_questions // per_page - 1
+        # Synthetic ids start at 1, so this cursor resumes on the same page
+        with self.app.app_context():
+            deep_cursor = encode_cursor((last_page - 1) * per_page)
+
+        first_page_time = self.time_request('/questions')
+        cursor_time = self.time_request(f'/questions?cursor={deep_cursor}')
+        offset_time = self.time_request(f'/questions?page={last_page}')
+
+        print(f'\npage 1: {first_page_time * 1000:.2f}ms, '
+              f'page {last_page} by cursor: {cursor_time * 1000:.2f}ms, '
+              f'page {last_page} by offset: {offset_time * 1000:.2f}ms')
+        # Generous bound so that the check is stable on noisy machines
+        self.assertLess(cursor_time, first_page_time * 3)
+
+
+class SerializationBenchmarkCase(SyntheticQuestionsCase):
+    """This class benchmarks the encoding of pages of questions"""
+
+    page_sizes = (10, 100, 1000)
+
+    def orm_page(self, page_size):
+        """Previous path: ORM instances, format() dicts and jsonify."""
+        questions = Question.query.order_by(Question.id).limit(page_size).all()
+        return jsonify({
+            'success': True,
+            'questions': [question.format() for question in questions],
+        }).get_data()
+
+    def row_page(self, page_size):
+        """Current path: column tuples and the app serializer."""
+        rows = Question.query.with_entities(*Question.columns()).order_by(Question.id).limit(page_size).all()
+        return json_response({
+            'success': True,
+            'questions': [Question.format_row(row) for row in rows],
+        }).get_data()
+
+
+    def test_row_tuples_and_serializer_are_faster_than_orm_and_jsonify(self):
+        """
+        Benchmark both paths at page sizes 10, 100 and 1000
+        """
+
+        serializer = self.app.extensions['json_serializer'].name
+        print()
+        with self.app.test_request_context():
+            for page_size in self.page_sizes:
+                self.assertEqual(
+                    json.loads(self.orm_page(page_size)),
+                    json.loads(self.row_page(page_size)))
+                orm_time = self.time_call(lambda: self.orm_page(page_size))
+                row_time = self.time_call(lambda: self.row_page(page_size))
+                print(f'{page_size} questions: ORM + jsonify {orm_time * 1000:.2f}ms, '
+                      f'rows + {serializer} {row_time * 1000:.2f}ms')
+            # Only the largest page is compared, small ones are dominated by noise
+            self.assertLess(row_time, orm_time)
+
+
+class SnapshotBenchmarkCase(SyntheticQuestionsCase):
+    """This class compares the question snapshot with the ORM path"""
+
+    def measure(self, load):
+        """Return what load() returns, the memory it holds and the RSS growth."""
+        rss_before = rss_bytes()
+        tracemalloc.start()
+        try:
+            loaded = load()
+            traced_bytes = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        return loaded, traced_bytes, rss_bytes() - rss_before
+
+
+    def test_snapshot_holds_less_memory_and_serves_faster(self):
+        """
+        Benchmark the memory held by every question as ORM instances and
+        as a snapshot, then the latency of the read endpoints of both apps
+        """
+
+        snapshot = QuestionSnapshot()
+        with self.app.app_context():
+            instances, orm_bytes, orm_rss = self.measure(lambda: Question.query.all())
+            del instances
+            db.session.remove()
+            _, snapshot_bytes, snapshot_rss = self.measure(snapshot.load)
+
+        snapshot_app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.db_file}',
+            'RESPONSE_CACHE_MAX_BYTES': 0,
+            'QUESTION_SNAPSHOT': True,
+        })
+        self.addCleanup(snapshot_app.extensions['change_feed'].stop)
+        snapshot_client = snapshot_app.test_client()
+        snapshot_client.get('/categories')
+
+        print(f'\n{self.total_questions} questions: ORM instances {orm_bytes / 2 ** 20:.1f}MiB '
+              f'(RSS +{orm_rss / 2 ** 20:.1f}MiB), snapshot {snapshot_bytes / 2 ** 20:.1f}MiB '
+              f'(RSS +{snapshot_rss / 2 ** 20:.1f}MiB, {snapshot.stats()["bytes"] / 2 ** 20:.1f}MiB reported)')
+        timings = {}
+        for url in ['/questions?page=1500', f'/categories/{self.categories}/questions?page=250']:
+            timings[url] = [
+                self.time_call(lambda: self.assertEqual(client.get(url).status_code, 200))
+                for client in (self.client(), snapshot_client)
+            ]
+        search = {'searchTerm': 'a'}
+        timings['search'] = [
+            self.time_call(lambda: self.assertEqual(client.post('/questions/search', json=search).status_code, 200))
+            for client in (self.client(), snapshot_client)
+        ]
+        for name, (orm_time, snapshot_time) in timings.items():
+            print(f'{name}: database {orm_time * 1000:.2f}ms, snapshot {snapshot_time * 1000:.2f}ms')
+
+        self.assertLess(snapshot_bytes, orm_bytes)
+        # Deep category pages are close to SQLite's indexed scan, the listing and search are not
+        self.assertLess(timings['/questions?page=1500'][1], timings['/questions?page=1500'][0])
+        self.assertLess(timings['search'][1], timings['search'][0])
+
+
+class HarnessCase(SyntheticQuestionsCase):
+    """This class runs every scenario of the benchmark harness on a small question bank"""
+
+    questions_per_category = 50
+    requests = 6
+
+
+    def test_every_scenario_runs_in_both_modes(self):
+        """
+        Run every scenario through the test client and a local HTTP
+        server - Expect no unexpected status and complete reports
+        """
+
+        state = {'dataset': {'categories': self.categories, 'questions': self.total_questions, 'difficulties': 5}}
+        results = [
+            run_scenario(FlaskClientTarget(self.app), scenario, state, self.requests, concurrency=2)
+            for scenario in SCENARIOS
+        ]
+        with serve(self.app) as url:
+            results += [
+                run_scenario(HttpTarget(url), scenario, state, self.requests, concurrency=2)
+                for scenario in SCENARIOS
+            ]
+        comparison = compare({'results': results}, {'results': results})
+
+        self.assertEqual(len(results), 2 * len(SCENARIOS))
+        for result in results:
+            self.assertEqual(result['errors'], 0, result)
+            self.assertEqual(result['requests'], self.requests)
+            self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+            self.assertLessEqual(result['p95_ms'], result['p99_ms'])
+        self.assertTrue(all(pair['throughput_ratio'] == 1 for pair in comparison))
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main(verbosity=2)